@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+
+# offline benchmarks for ytmndd. a local server stands in for ytmnd.com and
+# is reached as an http proxy, so the scraper requests the same urls it
+# would in production and none of them leave the machine.
+
+import contextlib
+import hashlib
+import io
+import json
+import os
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from optparse import OptionParser
+from urllib.parse import parse_qs, urlsplit
+
+from ytmndd import YTMND, ZOOM_STYLES, MediaStore, ResponseCache
+
+USER = "bench"
+
+
+def site_info(i, media_variety):
+    return {
+        "site": {
+            "domain": "site%d" % i,
+            "description": "benchmark site %d" % i,
+            "background": {"color": "#000000"},
+            "foreground": {
+                "placement": "mc" if i % 2 else "tile",
+                "url": "http://media.ytmnd.com/fg/%d.gif" % (i % media_variety),
+            },
+            "sound": {
+                "url": "http://media.ytmnd.com/snd/%d.mp3" % (i % media_variety),
+                "type": "mp3",
+                "file_type": "mp3",
+            },
+            "zoom_text": {
+                "line_1": "zoom text %d" % i,
+                "line_2": "second line" if i % 3 == 0 else "",
+                "line_3": "third line" if i % 6 == 0 else "",
+            },
+            "keywords": ["benchmark", "site%d" % i],
+            "user": {"user_name": USER},
+            "sound_origin": "",
+            "fg_image_origin": "",
+            "work_safe": i % 5 != 0,
+        }
+    }
+
+
+class MockYTMND(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, sites, media_size, latency, per_page=50, media_variety=10):
+        super().__init__(("127.0.0.1", 0), MockHandler)
+        self.sites = sites
+        self.latency = latency
+        self.per_page = per_page
+        self.media_variety = media_variety
+        self.media = os.urandom(media_size)
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body, content_type="text/html", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+
+        url = urlsplit(self.path)
+        host = url.hostname or self.headers.get("Host", "").split(":")[0]
+        subdomain = host.split(".")[0]
+
+        if host == "ytmnd.com" and url.path == "/users/%s/sites" % USER:
+            page = int(parse_qs(url.query).get("page", ["1"])[0])
+            return self.send(200, self.listing(page).encode("utf-8"))
+
+        if host.endswith(".ytmnd.com") and subdomain.startswith("site"):
+            i = int(subdomain[4:])
+            if url.path == "/":
+                return self.send(200, b"<script>ytmnd.site_id = %d;</script>" % i)
+            if url.path == "/info/%d/json" % i:
+                body = json.dumps(site_info(i, server.media_variety)).encode("utf-8")
+                etag = '"%s"' % hashlib.md5(body).hexdigest()
+                if self.headers.get("If-None-Match") == etag:
+                    return self.send(304, b"", headers={"ETag": etag})
+                return self.send(200, body, "application/json", {"ETag": etag})
+
+        if host == "media.ytmnd.com":
+            return self.media()
+
+        self.send(404, b"not found")
+
+    def listing(self, page):
+        server = self.server
+        pages = (server.sites + server.per_page - 1) // server.per_page
+        first = (page - 1) * server.per_page
+        lines = ["<html><body>"]
+        for i in range(first, min(first + server.per_page, server.sites)):
+            lines.append(
+                '<a class="profile_link" href="/users/%s">%s</a> '
+                '<a class="site_link" href="http://site%d.ytmnd.com">site</a>'
+                % (USER, USER, i)
+            )
+        for number in range(1, pages + 1):
+            lines.append(
+                '<a href="/users/%s/sites?page=%d">%d</a>' % (USER, number, number)
+            )
+        lines.append("</body></html>")
+        return "\n".join(lines)
+
+    def media(self):
+        body = self.server.media
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        requested = self.headers.get("Range", "")
+        if_range = self.headers.get("If-Range", etag)
+        if requested.startswith("bytes=") and if_range == etag:
+            start = int(requested[6:].split("-")[0])
+            if start >= len(body):
+                return self.send(
+                    416, b"", headers={"Content-Range": "bytes */%d" % len(body)}
+                )
+            return self.send(
+                206,
+                body[start:],
+                "application/octet-stream",
+                {
+                    "Content-Range": "bytes %d-%d/%d"
+                    % (start, len(body) - 1, len(body)),
+                    "ETag": etag,
+                },
+            )
+        self.send(200, body, "application/octet-stream", {"ETag": etag})
+
+
+def bench_fetch_user(
+    server, workers, cache=False, store=False, repeat=1, trace_memory=False
+):
+    directory = tempfile.mkdtemp(prefix="ytmndd-bench-")
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        results = []
+        for run in range(repeat):
+            ytmnd = YTMND()
+            ytmnd.proxy = server.url
+            ytmnd.rate = 0
+            ytmnd.workers = workers
+            ytmnd.fresh = True
+            if cache:
+                ytmnd.cache = ResponseCache(os.path.join(directory, "cache.sqlite"))
+            if store:
+                ytmnd.store = MediaStore(os.path.join(directory, "store"))
+
+            # tracemalloc slows allocation-heavy code down a lot, so peak
+            # python memory is only measured when asked for
+            requests_before = server.requests
+            if trace_memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                ytmnd.fetch_user(USER)
+            elapsed = time.perf_counter() - start
+            peak = 0
+            if trace_memory:
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+            results.append(
+                {
+                    "run": run + 1,
+                    "workers": workers,
+                    "cache": cache,
+                    "store": store,
+                    "sites": server.sites,
+                    "seconds": elapsed,
+                    "sites_per_second": server.sites / elapsed,
+                    "requests": server.requests - requests_before,
+                    "peak_python_mb": peak / (1024 * 1024),
+                }
+            )
+        return results
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_render(pages, zoom_style, shared_assets):
+    ytmnd = YTMND()
+    ytmnd.zoom_style = zoom_style
+    ytmnd.shared_assets = shared_assets
+    infos = [site_info(i, 10) for i in range(pages)]
+
+    directory = tempfile.mkdtemp(prefix="ytmndd-bench-")
+    try:
+        start = time.perf_counter()
+        size = 0
+        for info in infos:
+            for meta in ytmnd.write_index(info, directory).values():
+                size += meta["size"]
+        elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return {
+        "zoom_style": zoom_style,
+        "shared_assets": shared_assets,
+        "pages": pages,
+        "seconds": elapsed,
+        "pages_per_second": pages / elapsed,
+        "average_kb": size / pages / 1024,
+    }
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--sites", action="store", type="int", dest="sites", default=200)
+    parser.add_option(
+        "--media-size",
+        action="store",
+        type="int",
+        dest="media_size",
+        default=256 * 1024,
+    )
+    parser.add_option(
+        "--latency", action="store", type="float", dest="latency", default=0.01
+    )
+    parser.add_option("--workers", action="store", dest="workers", default="1,4,16")
+    parser.add_option("--pages", action="store", type="int", dest="pages", default=2000)
+    parser.add_option("--repeat", action="store", type="int", dest="repeat", default=1)
+    parser.add_option("--cache", action="store_true", default=False)
+    parser.add_option("--store", action="store_true", default=False)
+    parser.add_option("--trace-memory", action="store_true", default=False)
+    parser.add_option("--skip-fetch", action="store_true")
+    parser.add_option("--skip-render", action="store_true")
+    parser.add_option("--json", action="store_true")
+
+    (options, args) = parser.parse_args()
+
+    report = {"fetch_user": [], "render": []}
+
+    if not options.skip_fetch:
+        server = MockYTMND(options.sites, options.media_size, options.latency).start()
+        try:
+            for workers in [int(w) for w in options.workers.split(",")]:
+                report["fetch_user"].extend(
+                    bench_fetch_user(
+                        server,
+                        workers,
+                        options.cache,
+                        options.store,
+                        options.repeat,
+                        options.trace_memory,
+                    )
+                )
+        finally:
+            server.stop()
+
+    if not options.skip_render:
+        for zoom_style in ZOOM_STYLES:
+            for shared_assets in (False, True):
+                report["render"].append(
+                    bench_render(options.pages, zoom_style, shared_assets)
+                )
+
+    report["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    if options.json:
+        print(json.dumps(report, indent=2))
+    else:
+        if report["fetch_user"]:
+            print(
+                "fetch_user: %d sites, %d byte media, %.0f ms latency"
+                % (options.sites, options.media_size, options.latency * 1000)
+            )
+            print(
+                "%7s %3s %8s %9s %9s %9s"
+                % ("workers", "run", "seconds", "sites/s", "requests", "peak MB")
+            )
+            for result in report["fetch_user"]:
+                print(
+                    "%7d %3d %8.2f %9.1f %9d %9s"
+                    % (
+                        result["workers"],
+                        result["run"],
+                        result["seconds"],
+                        result["sites_per_second"],
+                        result["requests"],
+                        (
+                            "%.1f" % result["peak_python_mb"]
+                            if options.trace_memory
+                            else "-"
+                        ),
+                    )
+                )
+            print()
+
+        if report["render"]:
+            print("write_index: %d pages" % options.pages)
+            print(
+                "%-8s %6s %8s %9s %8s"
+                % ("zoom", "shared", "seconds", "pages/s", "avg KB")
+            )
+            for result in report["render"]:
+                print(
+                    "%-8s %6s %8.2f %9.0f %8.1f"
+                    % (
+                        result["zoom_style"],
+                        "yes" if result["shared_assets"] else "no",
+                        result["seconds"],
+                        result["pages_per_second"],
+                        result["average_kb"],
+                    )
+                )
+            print()
+
+        print("max rss: %.1f MB" % report["max_rss_mb"])
@@ -1,16 +1,1119 @@
 #!/usr/bin/env python3
 
+# the clock starts before the other imports so --profile-startup can show
+# what they cost
+import time
+
+IMPORTS_STARTED = time.perf_counter()
+
+import gzip
+import hashlib
+import html
+import importlib
 import json
 import os
 import os.path
+import queue
+import random
 import re
+import shutil
+import sqlite3
 import subprocess
 import sys
-import time
+import threading
+from contextlib import contextmanager, redirect_stdout
+from functools import partial
 from optparse import OptionParser
+from string import Template
+from urllib.parse import urljoin, urlsplit
+
+# requests and the other heavy modules are imported on first use, see
+# lazy_import and load_requests
+requests = None
+HTTPAdapter = None
+IMPORT_TIMES = {}
+
+
+class RequestsNotLoaded(Exception):
+    # stands in for the requests exceptions until load_requests binds the
+    # real ones, so except clauses work on paths that never touch the network
+    pass
+
+
+ChunkedEncodingError = RequestsNotLoaded
+RequestsConnectionError = RequestsNotLoaded
+RequestException = RequestsNotLoaded
+Timeout = RequestsNotLoaded
+STARTED = time.perf_counter()
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+PAGE_CSS = """\
+*{margin:0;padding:0;width:100%;height:100%;}
+body{font-size:12px;font-weight:normal;font-style:normal;overflow:hidden;}
+#zoom_text{position:absolute;left:0;top:0;width:1000px;z-index:10;text-align:center;font-family:Tahoma, sans-serif}
+#zoom_text div{position:absolute;width:1000px}
+@media (max-width: 768px) {
+  #zoom_text{left:50%;top:50%;margin-left:-500px;-webkit-transform:translate(0,-50%) scale(0.55);-ms-transform:translate(0,-50%) scale(0.55);transform:translate(0,-50%) scale(0.55);-webkit-transform-origin:center center;-ms-transform-origin:center center;transform-origin:center center;}
+}
+@media (max-width: 480px) {
+  #zoom_text{-webkit-transform:translate(0,-50%) scale(0.45);-ms-transform:translate(0,-50%) scale(0.45);transform:translate(0,-50%) scale(0.45);}
+}
+#unmute-overlay{position:fixed;top:0;left:0;width:100%;height:100%;background:rgba(0,0,0,0.9);display:-webkit-box;display:-webkit-flex;display:-ms-flexbox;display:flex;-webkit-box-align:center;-webkit-align-items:center;-ms-flex-align:center;align-items:center;-webkit-box-pack:center;-webkit-justify-content:center;-ms-flex-pack:center;justify-content:center;z-index:99999;cursor:pointer;}
+#unmute-btn{width:80px;height:80px;background:rgba(255,255,255,0.1);border:2px solid rgba(255,255,255,0.3);border-radius:50%;display:-webkit-box;display:-webkit-flex;display:-ms-flexbox;display:flex;-webkit-box-align:center;-webkit-align-items:center;-ms-flex-align:center;align-items:center;-webkit-box-pack:center;-webkit-justify-content:center;-ms-flex-pack:center;justify-content:center;font-size:32px;color:rgba(255,255,255,0.9);-webkit-transition:all 0.3s ease;transition:all 0.3s ease;}
+#unmute-btn:hover{background:rgba(255,255,255,0.2);border-color:rgba(255,255,255,0.5);-webkit-transform:scale(1.1);-ms-transform:scale(1.1);transform:scale(1.1);}
+"""
+
+PAGE_JS = """\
+(function() {
+  var audioUrl = document.body.getAttribute('data-audio');
+  var context = null;
+  var source = null;
+  var audioBuffer = null;
+  var isPlaying = false;
+  var fallbackAudio = null;
+
+  function hasWebAudio() {
+    return ('AudioContext' in window) || ('webkitAudioContext' in window);
+  }
+
+  function createContext() {
+    if ('AudioContext' in window) {
+      return new AudioContext();
+    } else if ('webkitAudioContext' in window) {
+      return new webkitAudioContext();
+    }
+    return null;
+  }
+
+  function loadAudioWithXHR(callback, errorCallback) {
+    var request = new XMLHttpRequest();
+    request.open('GET', audioUrl, true);
+    request.responseType = 'arraybuffer';
+    request.onload = function() {
+      if (request.status === 200) {
+        callback(request.response);
+      } else {
+        errorCallback('Request failed with status: ' + request.status);
+      }
+    };
+    request.onerror = function() {
+      errorCallback('Network error');
+    };
+    request.send();
+  }
+
+  function loopAudio() {
+    if (!isPlaying || !audioBuffer) return;
+
+    source = context.createBufferSource();
+    source.connect(context.destination);
+    source.buffer = audioBuffer;
+
+    try {
+      if (source.start) {
+        source.start(0);
+      } else if (source.noteOn) {
+        source.noteOn(0);
+      }
+    } catch(e) {
+      console.error('Start error:', e);
+    }
+
+    var duration = audioBuffer.duration * 1000;
+    var offset = audioBuffer.duration < 2 ? 0 : 60;
+    setTimeout(loopAudio, duration - offset);
+  }
+
+  function playWebAudio() {
+    context = createContext();
+    if (!context) {
+      fallbackToHTMLAudio();
+      return;
+    }
+
+    if (context.state === 'suspended') {
+      try {
+        context.resume();
+      } catch(e) {
+        console.error('Resume error:', e);
+      }
+    }
+
+    loadAudioWithXHR(
+      function(arrayBuffer) {
+        var decodeSuccess = function(buffer) {
+          audioBuffer = buffer;
+          isPlaying = true;
+          setTimeout(loopAudio, 0);
+        };
+        var decodeError = function(error) {
+          console.error('Decode error:', error);
+          fallbackToHTMLAudio();
+        };
+        try {
+          context.decodeAudioData(arrayBuffer, decodeSuccess, decodeError);
+        } catch(e) {
+          console.error('decodeAudioData exception:', e);
+          fallbackToHTMLAudio();
+        }
+      },
+      function(error) {
+        console.error('Load error:', error);
+        fallbackToHTMLAudio();
+      }
+    );
+  }
+
+  function fallbackToHTMLAudio() {
+    try {
+      fallbackAudio = new Audio(audioUrl);
+      fallbackAudio.loop = true;
+      var playPromise = fallbackAudio.play();
+      if (playPromise && playPromise.catch) {
+        playPromise.catch(function(error) {
+          console.error('HTML5 audio play failed:', error);
+        });
+      }
+      isPlaying = true;
+    } catch(e) {
+      console.error('Fallback audio failed:', e);
+    }
+  }
+
+  function startAudio() {
+    var overlay = document.getElementById('unmute-overlay');
+    if (overlay) {
+      overlay.style.display = 'none';
+    }
+
+    if (hasWebAudio()) {
+      try {
+        playWebAudio();
+      } catch(e) {
+        console.error('Web Audio failed:', e);
+        fallbackToHTMLAudio();
+      }
+    } else {
+      fallbackToHTMLAudio();
+    }
+  }
+
+  var overlay = document.getElementById('unmute-overlay');
+  if (overlay) {
+    overlay.addEventListener('click', function(e) {
+      e.preventDefault();
+      startAudio();
+    });
+    overlay.addEventListener('touchend', function(e) {
+      e.preventDefault();
+      startAudio();
+    });
+  }
+
+  document.addEventListener('keydown', function(e) {
+    var modifierKeys = [16, 17, 18];
+    if (modifierKeys.indexOf(e.keyCode) !== -1) {
+      return;
+    }
+    if (overlay && overlay.style.display !== 'none') {
+      startAudio();
+    }
+  });
+})();
+"""
+
+PAGE_TEMPLATE = Template(
+    """\
+<!DOCTYPE html>
+<html>
+<head>
+<meta charset='utf-8'>
+<meta name='viewport' content='width=device-width, initial-scale=1.0'>
+<title>$title</title>
+$styles</head>
+<body data-audio='$audio'>
+<div id="unmute-overlay">
+  <div id="unmute-btn">▶</div>
+</div>
+$zoom_text$audio_tag</body>
+$script<script type='application/json' id='ytmnd-data'>
+$data
+</script>
+</html>"""
+)
+
+SITE_LINK = re.compile(r"site_link\" href=\"http://(\S+).ytmn(d|sfw)?.com\"")
+PAGE_LINK = re.compile(r"href=\"([^\"]*/sites[^\"]*?\bpage[=/])(\d+)([^\"]*)\"")
+
+DATA_BLOCK = re.compile(
+    r"<script type='application/json' id='ytmnd-data'>\n(.*?)\n</script>", re.S
+)
+
+# ffmpeg settings per output format. mp3 is the default since every
+# browser's decodeAudioData can read it.
+TRANSCODE_ARGS = {
+    "mp3": ["-codec:a", "libmp3lame", "-q:a", "4", "-f", "mp3"],
+    "ogg": ["-codec:a", "libvorbis", "-q:a", "4", "-f", "ogg"],
+    "m4a": ["-codec:a", "aac", "-b:a", "128k", "-f", "ipod"],
+}
+
+# the parts of a site's info json that --deep searches for asset urls
+ASSET_SECTIONS = (
+    "foreground",
+    "background",
+    "sound",
+    "fg_image_origin",
+    "sound_origin",
+)
+
+RENDER_SETTINGS = (
+    "html_only",
+    "json_only",
+    "no_web_audio",
+    "shared_assets",
+    "zoom_style",
+)
+
+# zoom text lines in paint order, bottom line first, with their top offsets
+ZOOM_LINES = (("line_3", 269), ("line_2", 135), ("line_1", 1))
+
+ZOOM_STYLES = ("layers", "classes", "shadow")
+
+
+def zoom_layer(i):
+    # left, top offset, grey level and font size of the i-th of 21 layers
+    return i * 2, i, 0 if i == 21 else i * 4, i * 2
+
+
+def zoom_css():
+    # "classes" keeps the 21 layers per line but moves their geometry into
+    # shared rules; "shadow" draws only the front layer and fakes the trail
+    # behind it with a text-shadow stack
+    classes = []
+    for i in range(1, 22):
+        left, top, color, size = zoom_layer(i)
+        classes.append(
+            "#zoom_text .z%d{z-index:%d;left:%dpx;top:%dpx;color:rgb(%d,%d,%d);font-size:%dpt}\n"
+            % (i, i, left, top, color, color, color, size)
+        )
+    for depth, (key, top) in enumerate(ZOOM_LINES, 1):
+        classes.append(
+            "#zoom_text .zl%s{top:%dpx;z-index:%d}\n" % (key[-1], top, depth)
+        )
+
+    front_left, front_top, _, front_size = zoom_layer(21)
+    shadows = []
+    for i in range(20, 0, -1):
+        left, top, color, _ = zoom_layer(i)
+        shadows.append(
+            "%dpx %dpx 0 rgb(%d,%d,%d)"
+            % (left - front_left, top - front_top, color, color, color)
+        )
+    shadow = [
+        "#zoom_text .zs{left:%dpx;color:#000;font-size:%dpt;text-shadow:%s}\n"
+        % (front_left, front_size, ",".join(shadows))
+    ]
+    for depth, (key, top) in enumerate(ZOOM_LINES, 1):
+        shadow.append(
+            "#zoom_text .zs%s{top:%dpx;z-index:%d}\n"
+            % (key[-1], top + front_top, depth)
+        )
+
+    return {"layers": "", "classes": "".join(classes), "shadow": "".join(shadow)}
+
+
+ZOOM_CSS = zoom_css()
+
+CATALOG_TEMPLATE = Template(
+    """\
+<!DOCTYPE html>
+<html>
+<head>
+<meta charset='utf-8'>
+<meta name='viewport' content='width=device-width, initial-scale=1.0'>
+<title>ytmnd archive - page $number</title>
+<style>
+body{margin:0;padding:16px;background:#000;color:#ccc;font:13px Tahoma, sans-serif}
+a{color:#fff;text-decoration:none}
+nav{margin:8px 0}
+ul{list-style:none;margin:0;padding:0;display:grid;grid-template-columns:repeat(auto-fill,minmax(140px,1fr));gap:12px}
+li{overflow:hidden}
+img{display:block;width:120px;height:90px;object-fit:cover;background:#222}
+b,span{display:block;white-space:nowrap;overflow:hidden;text-overflow:ellipsis}
+em{color:#f55}
+</style>
+</head>
+<body>
+<nav>$total sites &middot; $nav</nav>
+<ul>
+$items
+</ul>
+<nav>$nav</nav>
+</body>
+</html>
+"""
+)
+
+PLACEMENTS = {
+    "mc": "background-position: center center; background-repeat: no-repeat;",
+    "tile": "background-position: top left; background-repeat: repeat;",
+}
+
+
+def lazy_import(name):
+    # imports a module on first use and remembers how long that took, for
+    # --profile-startup
+    module = sys.modules.get(name)
+    if module is None:
+        start = time.perf_counter()
+        module = importlib.import_module(name)
+        IMPORT_TIMES[name] = time.perf_counter() - start
+    return module
+
+
+def load_requests():
+    # requests (with urllib3, idna and certifi) takes longer to import than
+    # everything else together, so only commands that use the network load it
+    global requests, HTTPAdapter
+    global ChunkedEncodingError, RequestsConnectionError, RequestException, Timeout
+    if requests is not None:
+        return
+    module = lazy_import("requests")
+    exceptions = lazy_import("requests.exceptions")
+    HTTPAdapter = lazy_import("requests.adapters").HTTPAdapter
+    ChunkedEncodingError = exceptions.ChunkedEncodingError
+    RequestsConnectionError = exceptions.ConnectionError
+    RequestException = exceptions.RequestException
+    Timeout = exceptions.Timeout
+    requests = module
+
+
+def import_report():
+    if not IMPORT_TIMES:
+        return "no lazy imports"
+    lines = ["%-24s %9s" % ("module", "ms")]
+    for name, seconds in sorted(IMPORT_TIMES.items(), key=lambda item: -item[1]):
+        lines.append("%-24s %9.1f" % (name, seconds * 1000))
+    return "\n".join(lines)
+
+
+class RateLimiter:
+    # token bucket per host; sites live on their own subdomains, so buckets
+    # are keyed on the registered domain (ytmnd.com) rather than the full host
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def host_key(self, url):
+        host = urlsplit(url).hostname or ""
+        return ".".join(host.split(".")[-2:])
+
+    def acquire(self, url):
+        if not self.rate:
+            return 0
+
+        key = self.host_key(url)
+        with self.lock:
+            now = time.monotonic()
+            tokens, last = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate) - 1
+            self.buckets[key] = (tokens, now)
+
+        # a negative balance is a reservation: wait until our token is minted
+        if tokens < 0:
+            time.sleep(-tokens / self.rate)
+            return -tokens / self.rate
+        return 0
+
+
+class ResponseCache:
+    # sqlite store of domain -> site_id plus the raw info json, revalidated
+    # with etag/last-modified once older than ttl and evicted lru past max_size
+    def __init__(self, path, ttl=86400, max_size=256 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS sites ("
+            "domain TEXT PRIMARY KEY, site_id TEXT, info TEXT, etag TEXT, "
+            "last_modified TEXT, fetched REAL, accessed REAL, size INTEGER)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS sites_accessed ON sites (accessed)")
+        self.db.commit()
+
+    def lookup(self, domain):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT site_id, info, etag, last_modified, fetched "
+                "FROM sites WHERE domain = ?",
+                (domain,),
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                "UPDATE sites SET accessed = ? WHERE domain = ?", (time.time(), domain)
+            )
+            self.db.commit()
+
+        site_id, info, etag, last_modified, fetched = row
+        return {
+            "site_id": site_id,
+            "info": info,
+            "etag": etag,
+            "last_modified": last_modified,
+            "fresh": time.time() - fetched < self.ttl,
+        }
+
+    def store(self, domain, site_id, info, etag=None, last_modified=None):
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO sites VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (domain, site_id, info, etag, last_modified, now, now, len(info)),
+            )
+            self.evict()
+            self.db.commit()
+
+    def touch(self, domain):
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "UPDATE sites SET fetched = ?, accessed = ? WHERE domain = ?",
+                (now, now, domain),
+            )
+            self.db.commit()
+
+    def evict(self):
+        sql = "SELECT COALESCE(SUM(size), 0) FROM sites"
+        total = self.db.execute(sql).fetchone()[0]
+        if total <= self.max_size:
+            return
+
+        rows = self.db.execute("SELECT domain, size FROM sites ORDER BY accessed")
+        stale = []
+        for domain, size in rows:
+            if total <= self.max_size:
+                break
+            stale.append((domain,))
+            total -= size
+        self.db.executemany("DELETE FROM sites WHERE domain = ?", stale)
+
+
+class Manifest:
+    # per-user record of which sites are archived, so reruns only fetch the
+    # sites that failed or are new since last time. each change is appended
+    # to a journal next to the manifest, which is replayed on load and folded
+    # back into the manifest by close(), so recording a site costs one line
+    # rather than rewriting the whole file.
+    def __init__(self, path, root):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.root = root
+        self.lock = threading.Lock()
+        self.sites = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as fn:
+                self.sites = json.load(fn).get("sites", {})
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, encoding="utf-8") as fn:
+                for line in fn:
+                    try:
+                        change = json.loads(line)
+                    except ValueError:
+                        # a line cut short by a crash
+                        continue
+                    self.sites[change["domain"]] = change["entry"]
+        self.journal = None
+
+    def completed(self, domain, outputs):
+        entry = self.sites.get(domain)
+        if not entry or entry["status"] != "done":
+            return False
+        if not set(outputs) <= set(entry["outputs"]):
+            return False
+        return all(
+            os.path.exists(os.path.join(self.root, name)) for name in entry["files"]
+        )
+
+    def record(self, domain, status, outputs=(), files=None, parsed=None, error=None):
+        with self.lock:
+            entry = self.sites.get(domain, {"outputs": [], "files": {}})
+            if status == "done":
+                entry["outputs"] = sorted(set(entry["outputs"]) | set(outputs))
+            entry["files"].update(files or {})
+            entry["status"] = status
+            entry["updated"] = time.time()
+            if parsed is not None:
+                entry["parsed"] = parsed
+            if error is not None:
+                entry["error"] = error
+            else:
+                entry.pop("error", None)
+            self.sites[domain] = entry
+            if self.journal is None:
+                self.journal = open(self.journal_path, "a", encoding="utf-8")
+            self.journal.write(json.dumps({"domain": domain, "entry": entry}) + "\n")
+            self.journal.flush()
+
+    def close(self):
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            if not os.path.exists(self.journal_path):
+                return
+            partial = self.path + ".part"
+            with open(partial, "w", encoding="utf-8") as fn:
+                json.dump({"sites": self.sites}, fn, sort_keys=True, indent=1)
+            os.replace(partial, self.path)
+            os.remove(self.journal_path)
+
+
+class MediaStore:
+    # content-addressed blobs under objects/, with a url index so media
+    # shared between sites is downloaded once and hardlinked into each site
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.url_locks = {}
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(root, "tmp"), exist_ok=True)
+        self.db = sqlite3.connect(
+            os.path.join(root, "index.sqlite"), check_same_thread=False
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, sha256 TEXT, size INTEGER)"
+        )
+        self.db.commit()
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, "objects", digest[:2], digest[2:])
+
+    def lookup(self, url):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT sha256 FROM urls WHERE url = ?", (url,)
+            ).fetchone()
+        if row and os.path.exists(self.blob_path(row[0])):
+            return row[0]
+        return None
+
+    def url_lock(self, url):
+        with self.lock:
+            return self.url_locks.setdefault(url, threading.Lock())
+
+    def fetch(self, url, path, download):
+        # returns whether the url was already in the store
+        with self.url_lock(url):
+            digest = self.lookup(url)
+            hit = digest is not None
+            if not hit:
+                digest = self.add(url, download)
+
+        link_file(self.blob_path(digest), path)
+        return hit
+
+    def add(self, url, download):
+        temp = os.path.join(
+            self.root, "tmp", hashlib.sha256(url.encode("utf-8")).hexdigest()
+        )
+        download(url, temp)
+        digest = checksum(temp)
+        size = os.path.getsize(temp)
+
+        blob = self.blob_path(digest)
+        if os.path.exists(blob):
+            os.remove(temp)
+        else:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.replace(temp, blob)
+
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO urls VALUES (?, ?, ?)", (url, digest, size)
+            )
+            self.db.commit()
+        return digest
+
+
+class Transcoder:
+    # converted media keyed on the sha256 of the source file and the
+    # encoder settings, so a sound or gif shared between sites (or seen in
+    # an earlier run) is only ever encoded once. the encoders are separate
+    # programs, so threads that wait on them are enough to keep one busy
+    # per cpu.
+    def __init__(self, root, audio=None, gifs=False, processes=None):
+        self.root = root
+        self.audio = audio
+        self.gifs = gifs
+        self.processes = processes or os.cpu_count() or 1
+        futures = lazy_import("concurrent.futures")
+        self.pool = futures.ThreadPoolExecutor(max_workers=self.processes)
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(root, "tmp"), exist_ok=True)
+
+    def key_lock(self, key):
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+    def convert(self, kind, digest, source, path):
+        # returns whether the conversion was already cached
+        if kind == "gif":
+            job, args, ext = optimize_gif, (), "gif"
+        else:
+            job, args, ext = transcode_audio, (self.audio,), self.audio
+        settings = " ".join([kind] + TRANSCODE_ARGS.get(ext, []))
+        key = hashlib.sha256((settings + " " + digest).encode("utf-8")).hexdigest()
+        blob = os.path.join(self.root, "objects", key[:2], key[2:] + "." + ext)
+
+        with self.key_lock(key):
+            hit = os.path.exists(blob)
+            if not hit:
+                temp = os.path.join(self.root, "tmp", key + "." + ext)
+                self.pool.submit(job, source, temp, *args).result()
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                os.replace(temp, blob)
+
+        link_file(blob, path)
+        return hit
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class AssetFetcher:
+    # --deep downloads for one fetch_all or fetch_ytmnd call. an asset shared
+    # by several sites is downloaded once and linked from the first copy, and
+    # a failed download is forgotten so the next site that wants it retries
+    def __init__(self, fetch, workers):
+        self.fetch = fetch
+        self.pool = lazy_import("concurrent.futures").ThreadPoolExecutor(
+            max_workers=max(1, workers)
+        )
+        self.lock = threading.RLock()
+        self.jobs = {}
+
+    def submit(self, url, path):
+        with self.lock:
+            if url not in self.jobs:
+                future = self.pool.submit(self.fetch, url, path)
+                self.jobs[url] = (future, path)
+                future.add_done_callback(partial(self.forget, url))
+            return self.jobs[url]
+
+    def forget(self, url, future):
+        if future.exception() is None:
+            return
+        with self.lock:
+            if url in self.jobs and self.jobs[url][0] is future:
+                del self.jobs[url]
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class UserArchive:
+    # where one user's sites end up: their directory, manifest and json output
+    def __init__(self, ytmnd, user):
+        self.ytmnd = ytmnd
+        self.pages = {}
+        self.path = os.path.abspath(user)
+        self.directory = self.path
+        self.records = {}
+        self.lock = threading.Lock()
+
+        manifest_path = self.path + ".manifest.json"
+        if ytmnd.fresh:
+            for path in (manifest_path, manifest_path + ".journal"):
+                if os.path.exists(path):
+                    os.remove(path)
+        self.manifest = Manifest(manifest_path, self.directory)
+
+        if not ytmnd.json_only or ytmnd.media_only:
+            os.makedirs(self.directory, exist_ok=True)
+
+        self.writer = None
+        if ytmnd.json_only and ytmnd.ndjson:
+            self.writer = RecordWriter(
+                self.path + RecordWriter.extensions[ytmnd.compress], ytmnd.compress
+            )
+
+    def listed(self, page, domain):
+        with self.lock:
+            self.pages.setdefault(page, []).append(domain)
+
+    def domains(self):
+        with self.lock:
+            return [d for page in sorted(self.pages) for d in self.pages[page]]
+
+    def add(self, domain, record):
+        if not self.ytmnd.json_only:
+            return
+        if self.writer:
+            self.writer.write(record)
+        else:
+            with self.lock:
+                self.records[domain] = record
+
+    def close(self):
+        self.manifest.close()
+        if self.writer:
+            self.writer.close()
+        elif self.ytmnd.json_only:
+            self.ytmnd.write_json(
+                self.path,
+                [self.records[d] for d in self.domains() if d in self.records],
+            )
+
+
+class RecordWriter:
+    # appends one json record per line and flushes after each, so the file
+    # is usable (and tail-able) while a crawl is still running
+    extensions = {None: ".ndjson", "gzip": ".ndjson.gz", "zstd": ".ndjson.zst"}
+
+    def __init__(self, path, compress=None):
+        self.lock = threading.Lock()
+        self.raw = None
+        self.zstandard = None
+        if compress == "gzip":
+            self.fn = gzip.open(path, "wt", encoding="utf-8")
+        elif compress == "zstd":
+            import zstandard
+
+            self.zstandard = zstandard
+            self.raw = open(path, "wb")
+            self.fn = zstandard.ZstdCompressor().stream_writer(self.raw)
+        else:
+            self.fn = open(path, "w", encoding="utf-8")
+        self.compress = compress
+
+    def write(self, record):
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            if self.zstandard is not None:
+                self.fn.write(line.encode("utf-8"))
+                self.fn.flush(self.zstandard.FLUSH_BLOCK)
+            else:
+                self.fn.write(line)
+                self.fn.flush()
+
+    def close(self):
+        self.fn.close()
+        if self.raw is not None:
+            self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Pipeline:
+    # each stage runs on its own worker threads and hands jobs to the next
+    # through a bounded queue, so a slow stage holds back the ones feeding it
+    # instead of letting work pile up in memory
+    STOP = object()
+
+    def __init__(self, stages, size, on_error=None):
+        self.on_error = on_error
+        self.stages = []
+        for function, workers in stages:
+            threads = [
+                threading.Thread(
+                    target=self.work, args=(len(self.stages),), daemon=True
+                )
+                for _ in range(max(1, workers))
+            ]
+            self.stages.append((function, queue.Queue(maxsize=size), threads))
+
+        for _, _, threads in self.stages:
+            for thread in threads:
+                thread.start()
 
-import requests
-from requests.exceptions import RequestException
+    def put(self, job):
+        self.stages[0][1].put(job)
+
+    def work(self, stage):
+        function, inbox, _ = self.stages[stage]
+        while True:
+            job = inbox.get()
+            if job is self.STOP:
+                return
+            try:
+                result = function(job)
+            except Exception as e:
+                self.failed(job, e)
+                continue
+            if result is not None and stage + 1 < len(self.stages):
+                self.stages[stage + 1][1].put(result)
+
+    def failed(self, job, error):
+        # a failing error handler (a closed stdout, a full disk) must not take
+        # the worker down with it, or the queue in front of it stops draining
+        if self.on_error:
+            try:
+                self.on_error(job, error)
+            except Exception:
+                pass
+
+    def close(self):
+        for _, inbox, threads in self.stages:
+            for _ in threads:
+                inbox.put(self.STOP)
+            for thread in threads:
+                thread.join()
+
+
+class ArchiveIndex:
+    # sqlite index of parsed site records, with an fts5 table over title,
+    # keywords and zoom text so searches stay fast on very large archives
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sites (
+                id INTEGER PRIMARY KEY,
+                domain TEXT UNIQUE NOT NULL,
+                username TEXT,
+                title TEXT,
+                keywords TEXT,
+                zoom_text TEXT,
+                work_safe INTEGER,
+                record TEXT,
+                updated REAL
+            );
+            CREATE INDEX IF NOT EXISTS sites_username ON sites (username, work_safe);
+            CREATE VIRTUAL TABLE IF NOT EXISTS sites_fts
+                USING fts5(title, keywords, zoom_text);
+            """
+        )
+        self.db.commit()
+
+    def add(self, records):
+        now = time.time()
+        with self.lock:
+            for record in records:
+                keywords = record.get("keywords") or ""
+                if not isinstance(keywords, str):
+                    keywords = " ".join(str(keyword) for keyword in keywords)
+                zoom_text = record.get("zoom_text") or ""
+                if isinstance(zoom_text, dict):
+                    zoom_text = "\n".join(
+                        zoom_text.get(key, "") for key in ("line_1", "line_2", "line_3")
+                    ).strip()
+                row = (
+                    record["username"],
+                    record["title"],
+                    keywords,
+                    zoom_text,
+                    1 if record.get("work_safe") else 0,
+                    json.dumps(record),
+                    now,
+                )
+
+                existing = self.db.execute(
+                    "SELECT id FROM sites WHERE domain = ?", (record["domain"],)
+                ).fetchone()
+                if existing:
+                    rowid = existing[0]
+                    self.db.execute(
+                        "UPDATE sites SET username = ?, title = ?, keywords = ?, "
+                        "zoom_text = ?, work_safe = ?, record = ?, updated = ? "
+                        "WHERE id = ?",
+                        row + (rowid,),
+                    )
+                    self.db.execute("DELETE FROM sites_fts WHERE rowid = ?", (rowid,))
+                else:
+                    rowid = self.db.execute(
+                        "INSERT INTO sites (username, title, keywords, zoom_text, "
+                        "work_safe, record, updated, domain) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        row + (record["domain"],),
+                    ).lastrowid
+                self.db.execute(
+                    "INSERT INTO sites_fts (rowid, title, keywords, zoom_text) "
+                    "VALUES (?, ?, ?, ?)",
+                    (rowid, row[1], keywords, zoom_text),
+                )
+            self.db.commit()
+
+    def query(self, text=None, user=None, work_safe=None, limit=None):
+        sql = "SELECT sites.record FROM sites"
+        where = []
+        params = []
+        if text:
+            # quote every term so user input is never parsed as fts syntax
+            terms = " ".join('"%s"' % term.replace('"', '""') for term in text.split())
+            sql += " JOIN sites_fts ON sites_fts.rowid = sites.id"
+            where.append("sites_fts MATCH ?")
+            params.append(terms)
+        if user:
+            where.append("sites.username = ?")
+            params.append(user)
+        if work_safe is not None:
+            where.append("sites.work_safe = ?")
+            params.append(1 if work_safe else 0)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY sites.domain"
+        if limit:
+            sql += " LIMIT %d" % limit
+
+        with self.lock:
+            rows = self.db.execute(sql, params).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+
+class Metrics:
+    # per-stage timings and counters for a run. the stage a thread is in is
+    # tracked thread-locally, so bytes and retries are charged to it without
+    # threading a name through every call
+    LABELS = {
+        "assets": "result",
+        "cache": "result",
+        "sites": "result",
+        "store": "result",
+        "transcode": "result",
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.timings = {}
+        self.counters = {}
+        self.started = time.time()
+
+    @contextmanager
+    def time(self, stage):
+        previous = getattr(self.local, "stage", None)
+        self.local.stage = stage
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.local.stage = previous
+            self.observe(stage, time.perf_counter() - start)
+
+    def stage(self):
+        return getattr(self.local, "stage", None) or "other"
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.timings.setdefault(name, []).append(seconds)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def count_stage(self, name, amount=1):
+        self.count(name + "." + self.stage(), amount)
+
+    def snapshot(self):
+        with self.lock:
+            timings = {name: sorted(values) for name, values in self.timings.items()}
+            counters = dict(self.counters)
+
+        stages = {}
+        for name, values in timings.items():
+            stages[name] = {
+                "count": len(values),
+                "total": sum(values),
+                "p50": percentile(values, 0.5),
+                "p90": percentile(values, 0.9),
+                "p99": percentile(values, 0.99),
+                "max": values[-1],
+            }
+        return {
+            "elapsed": time.time() - self.started,
+            "stages": stages,
+            "counters": counters,
+        }
+
+    def summary(self):
+        snapshot = self.snapshot()
+        lines = [">> finished in %.1fs" % snapshot["elapsed"]]
+        lines.append(
+            "%-12s %7s %9s %8s %8s %8s %8s"
+            % ("stage", "count", "total", "p50", "p90", "p99", "max")
+        )
+        for name, stats in sorted(snapshot["stages"].items()):
+            lines.append(
+                "%-12s %7d %8.2fs %7.3fs %7.3fs %7.3fs %7.3fs"
+                % (
+                    name,
+                    stats["count"],
+                    stats["total"],
+                    stats["p50"],
+                    stats["p90"],
+                    stats["p99"],
+                    stats["max"],
+                )
+            )
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append("%-24s %d" % (name, value))
+        return "\n".join(lines)
+
+    def prometheus(self):
+        snapshot = self.snapshot()
+        lines = [
+            "# TYPE ytmndd_elapsed_seconds gauge",
+            "ytmndd_elapsed_seconds %f" % snapshot["elapsed"],
+            "# TYPE ytmndd_stage_seconds summary",
+        ]
+        for name, stats in sorted(snapshot["stages"].items()):
+            for key, quantile in (("p50", "0.5"), ("p90", "0.9"), ("p99", "0.99")):
+                lines.append(
+                    'ytmndd_stage_seconds{stage="%s",quantile="%s"} %f'
+                    % (name, quantile, stats[key])
+                )
+            lines.append(
+                'ytmndd_stage_seconds_sum{stage="%s"} %f' % (name, stats["total"])
+            )
+            lines.append(
+                'ytmndd_stage_seconds_count{stage="%s"} %d' % (name, stats["count"])
+            )
+
+        declared = set()
+        for key, value in sorted(snapshot["counters"].items()):
+            name, _, label = key.partition(".")
+            if name not in declared:
+                lines.append("# TYPE ytmndd_%s_total counter" % name)
+                declared.add(name)
+            lines.append(
+                'ytmndd_%s_total{%s="%s"} %d'
+                % (name, self.LABELS.get(name, "stage"), label, value)
+            )
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as fn:
+            if path.endswith((".prom", ".txt")):
+                fn.write(self.prometheus())
+            else:
+                json.dump(self.snapshot(), fn, indent=2, sort_keys=True)
+
+
+def percentile(values, fraction):
+    # nearest-rank percentile of an already sorted list
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def checksum(path, chunk_size=64 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
 class YTMND:
@@ -21,109 +1124,604 @@ class YTMND:
         self.json_only = False
         self.no_web_audio = False
         self.print_json = False
-        self.sleep = 5
+        self.sleep = 1
+        self.rate = None
+        self.burst = 4
+        self.workers = 1
+        self.page_workers = 4
+        self.media_workers = None
+        self.render_workers = 2
+        self.queue_size = None
+        self.pool_size = 10
+        self.timeout = 30
+        self.retries = 3
+        self.backoff = 1.0
+        self.max_retry_after = 300
+        self.proxy = None
+        self.chunk_size = 64 * 1024
+        self.fresh = False
+        self.shared_assets = False
+        self.assets_written = set()
+        self.processes = None
+        self.per_page = 200
+        self.zoom_style = "layers"
+        self.ndjson = False
+        self.compress = None
+        self.store = None
+        self.cache = None
+        self.index = None
+        self.transcoder = None
+        self.deep = False
+        self.asset_workers = 8
+        self.metrics = Metrics()
+        self.limiter = None
+        self.session = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        with self.lock:
+            if self.session is not None:
+                return
+
+            if self.rate is not None:
+                rate = self.rate
+            else:
+                rate = 1.0 / self.sleep if self.sleep else 0
+            self.limiter = RateLimiter(rate, self.burst)
+
+            load_requests()
+            pool_size = max(self.pool_size, self.workers)
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session = requests.Session()
+            session.headers["User-Agent"] = "Mozilla/5.0"
+            if self.proxy:
+                session.proxies = {"http": self.proxy, "https": self.proxy}
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self.session = session
+
+    def retry_delay(self, attempt, response=None):
+        # None means the server asked for a longer wait than max_retry_after,
+        # which is treated as a failure rather than stalling a worker on it
+        if response is not None and "Retry-After" in response.headers:
+            value = response.headers["Retry-After"]
+            delay = None
+            try:
+                delay = max(0.0, float(value))
+            except ValueError:
+                try:
+                    since = lazy_import("email.utils").parsedate_to_datetime(value)
+                    delay = max(0.0, since.timestamp() - time.time())
+                except (TypeError, ValueError):
+                    pass
+            if delay is not None:
+                return delay if delay <= self.max_retry_after else None
+
+        return self.backoff * (2**attempt) * random.uniform(0.5, 1.5)
+
+    def get(self, url, **kwargs):
+        if self.session is None:
+            self.connect()
+
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            waited = self.limiter.acquire(url)
+            if waited:
+                self.metrics.observe("rate_wait", waited)
+            try:
+                response = self.session.get(url, **kwargs)
+            except (RequestsConnectionError, Timeout):
+                if attempt >= self.retries:
+                    raise
+                delay = self.retry_delay(attempt)
+            else:
+                delay = None
+                if response.status_code in RETRY_STATUSES and attempt < self.retries:
+                    delay = self.retry_delay(attempt, response)
+                if delay is None:
+                    if not kwargs.get("stream"):
+                        self.metrics.count_stage("bytes", len(response.content))
+                    return response
+                response.close()
+
+            attempt += 1
+            self.metrics.count_stage("retries")
+            self.metrics.observe("retry_wait", delay)
+            time.sleep(delay)
+
+    def outputs(self):
+        if self.json_only:
+            return ["json", "media"] if self.media_only else ["json"]
+        elif self.media_only:
+            outputs = ["media"]
+        elif self.html_only:
+            return ["html"]
+        else:
+            outputs = ["media", "html"]
+        if self.transcoder is not None:
+            outputs.append("transcoded")
+        if self.deep:
+            outputs.append("assets")
+        return outputs
 
     def fetch_user(self, user):
         if user == "":
             print("expecting one ytmnd name, got " + str(sys.argv))
             return
 
-        ytmnd_name = user
+        self.fetch_all(users=[user])
+
+    def run_batch(self, stream, user_mode=False):
+        # one job per line, handled as soon as it arrives. the session, the
+        # caches and the rate limits carry over from job to job. stdout only
+        # carries a json status line per job; progress goes to stderr.
+        out = sys.stdout
+        for line in iter(stream.readline, ""):
+            domains, users = parse_targets([line], user_mode)
+            if not domains and not users:
+                continue
+
+            start = time.perf_counter()
+            status = {"job": line.strip()}
+            try:
+                with redirect_stdout(sys.stderr):
+                    counts = self.fetch_all(domains, users)
+                failed = counts["failed"] or counts["listings_failed"]
+                status.update(counts, status="failed" if failed else "done")
+            except Exception as e:
+                status.update(status="failed", error=str(e))
+            status["seconds"] = round(time.perf_counter() - start, 3)
+            print(json.dumps(status), file=out, flush=True)
+
+    def fetch_all(self, domains=(), users=(), name=None):
+        # every site from every user and domain list goes into one pipeline,
+        # so the whole batch shares the workers, the session and the rate
+        # limits. sites are queued as soon as a listing line names them.
+        # with --json-only, the domain list's records are collected under
+        # `name` the same way a user's are.
+        load_requests()
+        futures = lazy_import("concurrent.futures")
+        archives = []
+        jobs = {}
+        counts = {"done": 0, "skipped": 0, "failed": 0, "listings_failed": 0}
+        assets = self.asset_fetcher()
+        listed = None
+        if name and domains and self.json_only:
+            listed = UserArchive(self, name)
+            archives.append(listed)
+
+        stages = [
+            (self.resolve_site, self.workers),
+            (self.download_site, self.media_workers or self.workers),
+            (self.finish_site, self.render_workers),
+        ]
+        if self.transcoder is not None:
+            stages.insert(2, (self.transcode_site, self.transcoder.processes))
+        pipeline = Pipeline(
+            stages,
+            self.queue_size or 2 * max(1, self.workers),
+            self.site_failed,
+        )
+
+        def enqueue(domain, archive):
+            with self.lock:
+                job = jobs.get(domain)
+                if job is not None:
+                    if archive is listed or job["archive"] not in (None, listed):
+                        return
+                    if not job["started"]:
+                        # a domain given on its own also turned up in a user's
+                        # listing before it was fetched, so it goes in their
+                        # archive
+                        job.update(
+                            archive=archive,
+                            manifest=archive.manifest,
+                            directory=archive.directory,
+                        )
+                        return
+                # new, or already fetched outside the user's archive
+                job = jobs[domain] = self.site_job(
+                    domain, archive, counts=counts, assets=assets
+                )
+            pipeline.put(job)
+
         try:
-            response = requests.get(
-                "http://ytmnd.com/users/" + ytmnd_name + "/sites",
-                headers={"User-Agent": "Mozilla/5.0"},
-            )
+            for domain in domains:
+                if listed is not None:
+                    listed.listed(0, domain)
+                enqueue(domain, listed)
+
+            with futures.ThreadPoolExecutor(
+                max_workers=max(1, self.page_workers)
+            ) as pages:
+                for user in users:
+                    archive = self.discover(user, enqueue, pages, counts)
+                    if archive is not None:
+                        archives.append(archive)
+        finally:
+            pipeline.close()
+            for archive in archives:
+                archive.close()
+            if assets is not None:
+                assets.close()
+        return counts
+
+    def discover(self, user, enqueue, pool, counts=None):
+        base = "http://ytmnd.com/users/" + user + "/sites"
+
+        archive = None
+        try:
+            response = self.get(base, stream=True)
             response.raise_for_status()
-            ytmnd_html = response.text.splitlines()
+            archive = UserArchive(self, user)
+            pages = self.read_listing(response, base, archive, 1, enqueue)
         except RequestException as e:
             print(f"Error fetching user page: {e}")
-            return
+            self.tally(counts, "listings_failed")
+            return archive
 
-        domains = []
+        # listings may only link a window of page numbers, so keep following
+        # links found on later pages until no new page numbers turn up
+        fetched = {1}
+        while True:
+            todo = {n: url for n, url in pages.items() if n not in fetched}
+            if not todo:
+                break
+            fetched.update(todo)
+            jobs = {
+                pool.submit(self.fetch_listing, url, archive, n, enqueue): n
+                for n, url in todo.items()
+            }
+            for job in lazy_import("concurrent.futures").as_completed(jobs):
+                try:
+                    pages.update(job.result())
+                except RequestException as e:
+                    print(f"Error fetching page {jobs[job]} of {user}: {e}")
+                    self.tally(counts, "listings_failed")
 
-        for line in ytmnd_html:
-            if "profile_link" in line:
-                expr = r"site_link\" href=\"http://(\S+).ytmn(d|sfw)?.com\""
-                match = re.search(expr, line)
-                if match:
-                    domain = match.group(1)
-                    domains.append(domain)
+        if not self.json_only:
+            print(">> found %d domains" % len(archive.domains()))
+        return archive
 
-        if self.json_only:
-            if self.media_only:
-                os.makedirs(user, exist_ok=True)
-                os.chdir(user)
-            parsed = []
-            for domain in domains:
-                result = self.fetch_ytmnd(domain)
-                if result:
-                    parsed.append(result)
-            if self.media_only:
-                os.chdir("..")
-            self.write_json(ytmnd_name, parsed)
+    def fetch_listing(self, url, archive, page, enqueue):
+        response = self.get(url, stream=True)
+        response.raise_for_status()
+        return self.read_listing(response, url, archive, page, enqueue)
 
-        else:
-            print(">> found %d domains" % len(domains))
-            os.makedirs(user, exist_ok=True)
-            os.chdir(user)
-            for domain in domains:
-                self.fetch_ytmnd(domain)
-            os.chdir("..")
+    def read_listing(self, response, url, archive, page, enqueue):
+        if response.encoding is None:
+            response.encoding = "utf-8"
+
+        pages = {}
+        with response:
+            for line in response.iter_lines(decode_unicode=True):
+                size = len(line.encode(response.encoding, "replace")) + 1
+                self.metrics.count("bytes.listing", size)
+                if "profile_link" in line:
+                    match = SITE_LINK.search(line)
+                    if match:
+                        domain = match.group(1)
+                        archive.listed(page, domain)
+                        enqueue(domain, archive)
+                if "page" in line:
+                    for match in PAGE_LINK.finditer(line):
+                        prefix, number, suffix = match.groups()
+                        href = html.unescape(prefix + number + suffix)
+                        pages[int(number)] = urljoin(url, href)
+        return pages
+
+    def fetch_ytmnd(self, domain, manifest=None, directory="."):
+        load_requests()
+        assets = self.asset_fetcher()
+        site = self.site_job(
+            domain, manifest=manifest, directory=directory, assets=assets
+        )
+        try:
+            for stage in (
+                self.resolve_site,
+                self.download_site,
+                self.transcode_site,
+                self.finish_site,
+            ):
+                site = stage(site)
+                if site is None:
+                    return None
+        except Exception as e:
+            self.site_failed(site, e)
+            raise
+        finally:
+            if assets is not None:
+                assets.close()
+        return site["result"]
 
-    def fetch_ytmnd(self, domain):
+    def asset_fetcher(self):
+        if not self.deep:
+            return None
+        return AssetFetcher(self.fetch_asset, self.asset_workers)
+
+    def site_job(
+        self,
+        domain,
+        archive=None,
+        manifest=None,
+        directory=".",
+        counts=None,
+        assets=None,
+    ):
+        if archive is not None:
+            manifest = archive.manifest
+            directory = archive.directory
+        return {
+            "assets": assets,
+            "counts": counts,
+            "domain": domain,
+            "archive": archive,
+            "manifest": manifest,
+            "directory": directory,
+            "info": None,
+            "files": {},
+            "failed_assets": [],
+            "result": None,
+            "skipped": False,
+            "started": False,
+        }
+
+    def wants_media(self):
+        if self.print_json:
+            return False
+        return self.media_only or not (self.json_only or self.html_only)
+
+    def wants_html(self):
+        return not (self.print_json or self.json_only or self.media_only)
+
+    def resolve_site(self, site):
+        with self.lock:
+            site["started"] = True
+        domain = site["domain"]
+        manifest = site["manifest"]
         if domain == "":
             print("expecting one ytmnd name, got " + str(sys.argv))
+            self.tally(site["counts"], "failed")
             return None
 
+        if manifest and manifest.completed(domain, self.outputs()):
+            if not self.print_json:
+                print("skipping %s" % domain)
+            self.metrics.count("sites.skipped")
+            site["result"] = manifest.sites[domain].get("parsed")
+            site["skipped"] = True
+            self.tally(site["counts"], "skipped")
+            return site
+
         if not self.print_json:
             print("fetching %s" % domain)
-        if self.sleep:
-            time.sleep(self.sleep)
 
-        ytmnd_name = domain
         try:
-            response = requests.get(
-                "http://" + domain + ".ytmnd.com", headers={"User-Agent": "Mozilla/5.0"}
+            ytmnd_info = self.fetch_info(domain)
+        except RequestException as e:
+            print(f"Error fetching {domain}: {e}")
+            self.metrics.count("failures.info")
+            if manifest:
+                manifest.record(domain, "failed", error=str(e))
+            self.tally(site["counts"], "failed")
+            return None
+
+        if ytmnd_info is None:
+            print(f"Could not find site_id for {domain}")
+            self.metrics.count("failures.page")
+            if manifest:
+                manifest.record(domain, "failed", error="site_id not found")
+            self.tally(site["counts"], "failed")
+            return None
+
+        if self.print_json:
+            print(json.dumps(ytmnd_info, sort_keys=True, indent=4))
+
+        site["info"] = ytmnd_info
+        return site
+
+    def download_site(self, site):
+        if not site["skipped"] and self.wants_media():
+            have = self.kept_files(site)
+            # with --deep the extra assets download alongside the gif and sound
+            jobs = None
+            if site["assets"] is not None:
+                jobs = self.queue_assets(
+                    site["info"], site["directory"], site["assets"], have
+                )
+            site["files"].update(
+                self.fetch_media(site["info"], site["directory"], have)
             )
-            response.raise_for_status()
-            ytmnd_html = response.text
+            if jobs is not None:
+                written, failed = self.collect_assets(
+                    site["info"], site["directory"], jobs, site["files"]
+                )
+                site["files"].update(written)
+                site["failed_assets"] = failed
+        return site
+
+    def kept_files(self, site):
+        # a partial site from an earlier run keeps the files it already got,
+        # so the rerun only downloads what failed
+        manifest = site["manifest"]
+        entry = manifest.sites.get(site["domain"]) if manifest else None
+        if not entry or entry["status"] != "partial":
+            return {}
+        kept = {}
+        for name, meta in entry["files"].items():
+            path = os.path.join(site["directory"], name)
+            if meta and os.path.isfile(path) and os.path.getsize(path) == meta["size"]:
+                kept[name] = meta
+        return kept
+
+    def transcode_site(self, site):
+        if site["skipped"] or self.transcoder is None or not self.wants_media():
+            return site
+
+        ytmnd_info = site["info"]
+        domain = ytmnd_info["site"]["domain"]
+        files = site["files"]
+        gif_type, wav_type = self.media_types(ytmnd_info)
+        gif_name = "%s.%s" % (domain, gif_type)
+        wav_name = "%s.%s" % (domain, wav_type)
+
+        jobs = []
+        if self.transcoder.gifs and gif_type == "gif" and files.get(gif_name):
+            jobs.append(("gif", gif_name, gif_name))
+        audio = self.transcoder.audio
+        if audio and wav_type != audio and files.get(wav_name):
+            jobs.append(("audio", wav_name, "%s.%s" % (domain, audio)))
+
+        for kind, source, target in jobs:
+            path = os.path.join(site["directory"], target)
+            try:
+                with self.metrics.time("transcode"):
+                    hit = self.transcoder.convert(
+                        kind,
+                        files[source]["sha256"],
+                        os.path.join(site["directory"], source),
+                        path,
+                    )
+                self.metrics.count("transcode.hit" if hit else "transcode.miss")
+            except (subprocess.CalledProcessError, OSError) as e:
+                print(f"Error transcoding {source}: {e}")
+                self.metrics.count("failures.transcode")
+                files[target] = None
+                continue
+
+            files[target] = self.file_info(path)
+            if kind == "audio":
+                # the page and the parsed record point at the new sound; the
+                # original stays next to it
+                ytmnd_info.setdefault("ytmndd", {})["sound_type"] = audio
+
+        return site
+
+    def finish_site(self, site):
+        domain = site["domain"]
+        archive = site["archive"]
+        manifest = site["manifest"]
+        files = site["files"]
+
+        parsed = None
+        failed = False
+        if site["skipped"]:
+            result = parsed = site["result"]
+        elif self.print_json:
+            result = site["info"]
+        else:
+            if self.wants_html():
+                with self.metrics.time("render"):
+                    files.update(self.write_index(site["info"], site["directory"]))
+
+            parsed = self.parse_json(site["info"])
+            failed = None in files.values() or bool(site["failed_assets"])
+            if manifest:
+                if None in files.values():
+                    missing = sorted(
+                        name for name, meta in files.items() if meta is None
+                    )
+                    manifest.record(
+                        domain,
+                        "failed",
+                        files={k: v for k, v in files.items() if v is not None},
+                        parsed=parsed,
+                        error="could not download " + ", ".join(missing),
+                    )
+                elif site["failed_assets"]:
+                    # the page works, but a rerun should retry the missing assets
+                    manifest.record(
+                        domain,
+                        "partial",
+                        files=files,
+                        parsed=parsed,
+                        error="could not download " + ", ".join(site["failed_assets"]),
+                    )
+                else:
+                    # the parsed record is kept either way, so json output comes free
+                    outputs = self.outputs() + ["json"]
+                    manifest.record(domain, "done", outputs, files, parsed)
+
+            result = parsed if self.json_only else site["info"]
+            self.metrics.count("sites.fetched")
+
+        if self.index is not None and parsed:
+            self.index.add([parsed])
+        if archive is not None and result:
+            archive.add(domain, result)
+        site["result"] = result
+        if not site["skipped"]:
+            self.tally(site["counts"], "failed" if failed else "done")
+        return site
+
+    def tally(self, counts, result):
+        if counts is not None:
+            with self.lock:
+                counts[result] += 1
+
+    def site_failed(self, site, error):
+        self.tally(site["counts"], "failed")
+        print(f"Error processing {site['domain']}: {error}")
+        self.metrics.count_stage("failures")
+        if site["manifest"]:
+            site["manifest"].record(site["domain"], "failed", error=str(error))
+
+    def fetch_info(self, domain):
+        cached = self.cache.lookup(domain) if self.cache else None
+        if cached and cached["fresh"]:
+            self.metrics.count("cache.fresh")
+            return json.loads(cached["info"])
+        if self.cache:
+            self.metrics.count("cache.stale" if cached else "cache.miss")
+
+        # site ids never change, so a stale entry still saves the page fetch
+        if cached:
+            ytmnd_id = cached["site_id"]
+        else:
+            with self.metrics.time("page"):
+                response = self.get("http://" + domain + ".ytmnd.com")
+                response.raise_for_status()
+                ytmnd_html = response.text
 
             expr = r"ytmnd.site_id = (\d+);"
             match = re.search(expr, ytmnd_html)
             if not match:
-                print(f"Could not find site_id for {domain}")
                 return None
             ytmnd_id = match.group(1)
 
-            response = requests.get(
+        headers = {}
+        if cached and cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached and cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+        with self.metrics.time("info"):
+            response = self.get(
                 "http://" + domain + ".ytmnd.com/info/" + ytmnd_id + "/json",
-                headers={"User-Agent": "Mozilla/5.0"},
+                headers=headers,
             )
-            response.raise_for_status()
-            ytmnd_info = response.json()
+        if cached and response.status_code == 304:
+            self.metrics.count("cache.revalidated")
+            self.cache.touch(domain)
+            return json.loads(cached["info"])
 
-        except RequestException as e:
-            print(f"Error fetching {domain}: {e}")
-            return None
+        response.raise_for_status()
+        ytmnd_info = response.json()
 
-        if self.print_json:
-            print(json.dumps(ytmnd_info, sort_keys=True, indent=4))
-        elif self.json_only:
-            if self.media_only:
-                self.fetch_media(ytmnd_info)
-            return self.parse_json(ytmnd_info)
-        elif self.media_only:
-            self.fetch_media(ytmnd_info)
-        elif self.html_only:
-            self.write_index(ytmnd_info)
-        else:
-            self.fetch_media(ytmnd_info)
-            self.write_index(ytmnd_info)
+        if self.cache:
+            self.cache.store(
+                domain,
+                ytmnd_id,
+                response.text,
+                response.headers.get("ETag"),
+                response.headers.get("Last-Modified"),
+            )
 
         return ytmnd_info
 
-    def fetch_media(self, ytmnd_info):
+    def media_sources(self, ytmnd_info):
+        # the gif and the one sound a page plays, as (url, name) pairs
         domain = ytmnd_info["site"]["domain"]
         original_gif = ytmnd_info["site"]["foreground"]["url"]
         gif_type = original_gif.split(".")[-1]
@@ -137,311 +1735,348 @@ class YTMND:
                 original_wav = value["file_url"]
                 wav_type = ytmnd_info["site"]["sound"]["file_type"]
 
-        try:
-            gif_response = requests.get(
-                original_gif, headers={"User-Agent": "Mozilla/5.0"}
-            )
-            gif_response.raise_for_status()
-            with open(f"{domain}.{gif_type}", "wb") as f:
-                f.write(gif_response.content)
-        except RequestException as e:
-            print(f"Error downloading gif: {e}")
+        return (
+            (original_gif, f"{domain}.{gif_type}"),
+            (original_wav, f"{domain}.{wav_type}"),
+        )
 
-        try:
-            wav_response = requests.get(
-                original_wav, headers={"User-Agent": "Mozilla/5.0"}
-            )
-            wav_response.raise_for_status()
-            with open(f"{domain}.{wav_type}", "wb") as f:
-                f.write(wav_response.content)
-        except RequestException as e:
-            print(f"Error downloading audio: {e}")
+    def fetch_media(self, ytmnd_info, directory=".", have=None):
+        (original_gif, gif_name), (original_wav, wav_name) = self.media_sources(
+            ytmnd_info
+        )
+        # files kept from an earlier partial run are not downloaded again
+        have = have or {}
+        files = {name: have[name] for name in (gif_name, wav_name) if name in have}
+
+        if gif_name not in files:
+            try:
+                path = os.path.join(directory, gif_name)
+                with self.metrics.time("gif"):
+                    self.fetch_file(original_gif, path)
+                files[gif_name] = self.file_info(path)
+            except (RequestException, OSError) as e:
+                print(f"Error downloading gif: {e}")
+                self.metrics.count("failures.gif")
+                files[gif_name] = None
+
+        if wav_name not in files:
+            try:
+                path = os.path.join(directory, wav_name)
+                with self.metrics.time("audio"):
+                    self.fetch_file(original_wav, path)
+                files[wav_name] = self.file_info(path)
+            except (RequestException, OSError) as e:
+                print(f"Error downloading audio: {e}")
+                self.metrics.count("failures.audio")
+                files[wav_name] = None
+
+        return files
 
-    def write_index(self, ytmnd_info):
+    def queue_assets(self, ytmnd_info, directory, assets, have=None):
         domain = ytmnd_info["site"]["domain"]
-        bgcolor = ytmnd_info["site"]["background"]["color"]
-        title = ytmnd_info["site"]["description"]
-        placement = ytmnd_info["site"]["foreground"]["placement"]
+        primary = dict(self.media_sources(ytmnd_info))
+        have = have or {}
 
-        original_gif = ytmnd_info["site"]["foreground"]["url"]
-        gif_type = original_gif.split(".")[-1]
+        jobs = {}
+        for url, refs in asset_urls(ytmnd_info).items():
+            if url in primary:
+                jobs[url] = (refs, None, primary[url])
+                continue
+            name = posix_path(domain + ".assets", asset_name(url))
+            path = os.path.join(directory, name)
+            if name in have:
+                future = lazy_import("concurrent.futures").Future()
+                future.set_result(have[name])
+                jobs[url] = (refs, (future, path), name)
+            else:
+                jobs[url] = (refs, assets.submit(url, path), name)
+        return jobs
+
+    def fetch_asset(self, url, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.metrics.time("asset"):
+            self.fetch_file(url, path)
+        return self.file_info(path)
+
+    def collect_assets(self, ytmnd_info, directory, jobs, files):
+        domain = ytmnd_info["site"]["domain"]
+        assets = []
+        written = {}
+        failed = []
+        for url, (refs, job, name) in sorted(jobs.items()):
+            asset = {"url": url, "refs": refs, "file": name}
+            if job is None:
+                asset["status"] = "primary" if files.get(name) else "failed"
+                assets.append(asset)
+                continue
+
+            future, source = job
+            path = os.path.join(directory, name)
+            try:
+                info = future.result()
+                if os.path.abspath(source) != os.path.abspath(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    link_file(source, path)
+            except (RequestException, OSError) as e:
+                self.metrics.count("failures.asset")
+                asset.update(status="failed", error=str(e))
+                failed.append(url)
+            else:
+                self.metrics.count("assets.fetched")
+                asset.update(status="done", **info)
+                written[name] = info
+            assets.append(asset)
+
+        name = domain + ".assets.json"
+        path = os.path.join(directory, name)
+        with open(path + ".part", "w", encoding="utf-8") as fn:
+            json.dump(
+                {"domain": domain, "assets": assets}, fn, sort_keys=True, indent=1
+            )
+        os.replace(path + ".part", path)
+        written[name] = self.file_info(path)
+        return written, failed
+
+    def fetch_file(self, url, path):
+        if self.store:
+            if self.store.fetch(url, path, self.download):
+                self.metrics.count("store.hit")
+            else:
+                self.metrics.count("store.miss")
+        else:
+            self.download(url, path)
+
+    def file_info(self, path):
+        return {
+            "size": os.path.getsize(path),
+            "sha256": checksum(path, self.chunk_size),
+        }
+
+    def download(self, url, path):
+        # stream into <path>.part and rename into place once complete; a
+        # leftover .part from an interrupted run is resumed with a Range
+        # request, validated against <path>.part.meta
+        partial = path + ".part"
+        attempt = 0
+        while True:
+            try:
+                self.download_part(url, partial)
+                break
+            except ChunkedEncodingError:
+                # get() already retries connecting and timeouts; this only
+                # covers a body that broke off part way through
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+
+        os.replace(partial, path)
+        if os.path.exists(partial + ".meta"):
+            os.remove(partial + ".meta")
+
+    def download_part(self, url, partial):
+        # a .part is only resumed with If-Range carrying the validator of the
+        # response that started it, so a file that changed since comes back
+        # whole instead of getting its new tail spliced onto the old prefix
+        meta_path = partial + ".meta"
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        meta = {}
+        if offset:
+            try:
+                with open(meta_path, encoding="utf-8") as fn:
+                    meta = json.load(fn)
+            except (OSError, ValueError):
+                meta = {}
+        validator = meta.get("etag") or meta.get("last_modified")
+
+        headers = {"Accept-Encoding": "identity"}
+        if offset and validator:
+            headers["Range"] = "bytes=%d-" % offset
+            headers["If-Range"] = validator
+        else:
+            offset = 0
+
+        with self.get(url, headers=headers, stream=True) as response:
+            content_range = response.headers.get("Content-Range", "")
+            if offset and response.status_code == 416:
+                if (
+                    content_range == "bytes */%d" % offset
+                    and meta.get("length") == offset
+                ):
+                    return
+                return self.restart_part(url, partial)
+
+            response.raise_for_status()
+            if response.status_code == 206:
+                expected = "bytes %d-" % offset
+                total = content_range.rpartition("/")[2]
+                if not (
+                    offset
+                    and content_range.startswith(expected)
+                    and total == str(meta.get("length"))
+                ):
+                    return self.restart_part(url, partial)
+                mode = "ab"
+            else:
+                mode = "wb"
+                etag = response.headers.get("ETag", "")
+                length = response.headers.get("Content-Length")
+                with open(meta_path, "w", encoding="utf-8") as fn:
+                    json.dump(
+                        {
+                            # If-Range only takes strong etags
+                            "etag": None if etag.startswith("W/") else etag or None,
+                            "last_modified": response.headers.get("Last-Modified"),
+                            "length": int(length) if length else None,
+                        },
+                        fn,
+                    )
+
+            with open(partial, mode) as f:
+                for chunk in response.iter_content(self.chunk_size):
+                    f.write(chunk)
+                    self.metrics.count_stage("bytes", len(chunk))
+
+    def restart_part(self, url, partial):
+        for path in (partial, partial + ".meta"):
+            if os.path.exists(path):
+                os.remove(path)
+        return self.download_part(url, partial)
+
+    def write_index(self, ytmnd_info, directory="."):
+        name = ytmnd_info["site"]["domain"] + ".html"
+        path = os.path.join(directory, name)
+        page = self.render_index(ytmnd_info)
+
+        if self.shared_assets:
+            self.write_assets(directory)
+
+        with open(path, "w", encoding="utf-8") as fn:
+            fn.write(page)
+
+        return {name: self.file_info(path)}
+
+    def media_types(self, ytmnd_info):
+        # extensions of the files a page uses, after any local transcoding
+        gif_type = ytmnd_info["site"]["foreground"]["url"].split(".")[-1]
         wav_type = ytmnd_info["site"]["sound"]["type"]
 
         if "alternates" in ytmnd_info["site"]["sound"]:
             key = list(ytmnd_info["site"]["sound"]["alternates"].keys())[0]
             value = ytmnd_info["site"]["sound"]["alternates"][key]
             if value["file_type"] != "swf":
-                original_wav = value["file_url"]
                 wav_type = ytmnd_info["site"]["sound"]["file_type"]
 
-        with open(domain + ".html", "w", encoding="utf-8") as fn:
-            fn.write("<!DOCTYPE html>\n")
-            fn.write("<html>\n")
-            fn.write("<head>\n")
-            fn.write("<meta charset='utf-8'>\n")
-            fn.write(
-                "<meta name='viewport' content='width=device-width, initial-scale=1.0'>\n"
-            )
-            fn.write("<title>%s</title>\n" % title)
-            fn.write("<style>\n")
-            fn.write("*{margin:0;padding:0;width:100%;height:100%;}\n")
-            fn.write(
-                "body{font-size:12px;font-weight:normal;font-style:normal;overflow:hidden;"
-            )
-            fn.write("background-color:%s;" % bgcolor)
-            fn.write("background-image:url(%s.%s);" % (domain, gif_type))
-            if placement == "mc":
-                fn.write(
-                    "background-position: center center; background-repeat: no-repeat;}"
-                )
-            elif placement == "tile":
-                fn.write("background-position: top left; background-repeat: repeat;}")
-            fn.write("\n")
-            fn.write(
-                "#zoom_text{position:absolute;left:0;top:0;width:1000px;z-index:10;text-align:center;font-family:Tahoma, sans-serif}\n"
-            )
-            fn.write("#zoom_text div{position:absolute;width:1000px}\n")
-            fn.write("@media (max-width: 768px) {\n")
-            fn.write(
-                "  #zoom_text{left:50%;top:50%;margin-left:-500px;-webkit-transform:translate(0,-50%) scale(0.55);-ms-transform:translate(0,-50%) scale(0.55);transform:translate(0,-50%) scale(0.55);-webkit-transform-origin:center center;-ms-transform-origin:center center;transform-origin:center center;}\n"
-            )
-            fn.write("}\n")
-            fn.write("@media (max-width: 480px) {\n")
-            fn.write(
-                "  #zoom_text{-webkit-transform:translate(0,-50%) scale(0.45);-ms-transform:translate(0,-50%) scale(0.45);transform:translate(0,-50%) scale(0.45);}\n"
-            )
-            fn.write("}\n")
-            fn.write(
-                "#unmute-overlay{position:fixed;top:0;left:0;width:100%;height:100%;background:rgba(0,0,0,0.9);display:-webkit-box;display:-webkit-flex;display:-ms-flexbox;display:flex;-webkit-box-align:center;-webkit-align-items:center;-ms-flex-align:center;align-items:center;-webkit-box-pack:center;-webkit-justify-content:center;-ms-flex-pack:center;justify-content:center;z-index:99999;cursor:pointer;}\n"
-            )
-            fn.write(
-                "#unmute-btn{width:80px;height:80px;background:rgba(255,255,255,0.1);border:2px solid rgba(255,255,255,0.3);border-radius:50%;display:-webkit-box;display:-webkit-flex;display:-ms-flexbox;display:flex;-webkit-box-align:center;-webkit-align-items:center;-ms-flex-align:center;align-items:center;-webkit-box-pack:center;-webkit-justify-content:center;-ms-flex-pack:center;justify-content:center;font-size:32px;color:rgba(255,255,255,0.9);-webkit-transition:all 0.3s ease;transition:all 0.3s ease;}\n"
-            )
-            fn.write(
-                "#unmute-btn:hover{background:rgba(255,255,255,0.2);border-color:rgba(255,255,255,0.5);-webkit-transform:scale(1.1);-ms-transform:scale(1.1);transform:scale(1.1);}\n"
-            )
-            fn.write("</style>\n")
-            fn.write("</head>\n")
-
-            fn.write("<body>\n")
-
-            fn.write('<div id="unmute-overlay">\n')
-            fn.write('  <div id="unmute-btn">▶</div>\n')
-            fn.write("</div>\n")
-
-            self.write_zoom_text(fn, ytmnd_info)
-
-            if self.no_web_audio:
-                fn.write("<audio src='%s.%s' loop autoplay>\n" % (domain, wav_type))
-
-            fn.write("</body>\n")
-
-            fn.write("<script>\n")
-            fn.write("(function() {\n")
-            fn.write("  var audioUrl = '%s.%s';\n" % (domain, wav_type))
-            fn.write("  var context = null;\n")
-            fn.write("  var source = null;\n")
-            fn.write("  var audioBuffer = null;\n")
-            fn.write("  var isPlaying = false;\n")
-            fn.write("  var fallbackAudio = null;\n")
-            fn.write("  \n")
-            fn.write("  function hasWebAudio() {\n")
-            fn.write(
-                "    return ('AudioContext' in window) || ('webkitAudioContext' in window);\n"
-            )
-            fn.write("  }\n")
-            fn.write("  \n")
-            fn.write("  function createContext() {\n")
-            fn.write("    if ('AudioContext' in window) {\n")
-            fn.write("      return new AudioContext();\n")
-            fn.write("    } else if ('webkitAudioContext' in window) {\n")
-            fn.write("      return new webkitAudioContext();\n")
-            fn.write("    }\n")
-            fn.write("    return null;\n")
-            fn.write("  }\n")
-            fn.write("  \n")
-            fn.write("  function loadAudioWithXHR(callback, errorCallback) {\n")
-            fn.write("    var request = new XMLHttpRequest();\n")
-            fn.write("    request.open('GET', audioUrl, true);\n")
-            fn.write("    request.responseType = 'arraybuffer';\n")
-            fn.write("    request.onload = function() {\n")
-            fn.write("      if (request.status === 200) {\n")
-            fn.write("        callback(request.response);\n")
-            fn.write("      } else {\n")
-            fn.write(
-                "        errorCallback('Request failed with status: ' + request.status);\n"
-            )
-            fn.write("      }\n")
-            fn.write("    };\n")
-            fn.write("    request.onerror = function() {\n")
-            fn.write("      errorCallback('Network error');\n")
-            fn.write("    };\n")
-            fn.write("    request.send();\n")
-            fn.write("  }\n")
-            fn.write("  \n")
-            fn.write("  function loopAudio() {\n")
-            fn.write("    if (!isPlaying || !audioBuffer) return;\n")
-            fn.write("    \n")
-            fn.write("    source = context.createBufferSource();\n")
-            fn.write("    source.connect(context.destination);\n")
-            fn.write("    source.buffer = audioBuffer;\n")
-            fn.write("    \n")
-            fn.write("    try {\n")
-            fn.write("      if (source.start) {\n")
-            fn.write("        source.start(0);\n")
-            fn.write("      } else if (source.noteOn) {\n")
-            fn.write("        source.noteOn(0);\n")
-            fn.write("      }\n")
-            fn.write("    } catch(e) {\n")
-            fn.write("      console.error('Start error:', e);\n")
-            fn.write("    }\n")
-            fn.write("    \n")
-            fn.write("    var duration = audioBuffer.duration * 1000;\n")
-            fn.write("    var offset = audioBuffer.duration < 2 ? 0 : 60;\n")
-            fn.write("    setTimeout(loopAudio, duration - offset);\n")
-            fn.write("  }\n")
-            fn.write("  \n")
-            fn.write("  function playWebAudio() {\n")
-            fn.write("    context = createContext();\n")
-            fn.write("    if (!context) {\n")
-            fn.write("      fallbackToHTMLAudio();\n")
-            fn.write("      return;\n")
-            fn.write("    }\n")
-            fn.write("    \n")
-            fn.write("    if (context.state === 'suspended') {\n")
-            fn.write("      try {\n")
-            fn.write("        context.resume();\n")
-            fn.write("      } catch(e) {\n")
-            fn.write("        console.error('Resume error:', e);\n")
-            fn.write("      }\n")
-            fn.write("    }\n")
-            fn.write("    \n")
-            fn.write("    loadAudioWithXHR(\n")
-            fn.write("      function(arrayBuffer) {\n")
-            fn.write("        var decodeSuccess = function(buffer) {\n")
-            fn.write("          audioBuffer = buffer;\n")
-            fn.write("          isPlaying = true;\n")
-            fn.write("          setTimeout(loopAudio, 0);\n")
-            fn.write("        };\n")
-            fn.write("        var decodeError = function(error) {\n")
-            fn.write("          console.error('Decode error:', error);\n")
-            fn.write("          fallbackToHTMLAudio();\n")
-            fn.write("        };\n")
-            fn.write("        try {\n")
-            fn.write(
-                "          context.decodeAudioData(arrayBuffer, decodeSuccess, decodeError);\n"
+        overrides = ytmnd_info.get("ytmndd", {})
+        return gif_type, overrides.get("sound_type", wav_type)
+
+    def render_index(self, ytmnd_info):
+        domain = ytmnd_info["site"]["domain"]
+        bgcolor = ytmnd_info["site"]["background"]["color"]
+        title = ytmnd_info["site"]["description"]
+        placement = ytmnd_info["site"]["foreground"]["placement"]
+
+        gif_type, wav_type = self.media_types(ytmnd_info)
+
+        gif = html.escape("%s.%s" % (domain, gif_type))
+        wav = html.escape("%s.%s" % (domain, wav_type))
+
+        site_css = "body{background-color:%s;background-image:url('%s');%s}\n" % (
+            html.escape(bgcolor),
+            gif,
+            PLACEMENTS.get(placement, ""),
+        )
+        if self.shared_assets:
+            styles = "<link rel='stylesheet' href='ytmnd.css'>\n<style>\n%s</style>\n"
+            styles = styles % site_css
+            script = "<script src='ytmnd.js'></script>\n"
+        else:
+            styles = "<style>\n%s%s%s</style>\n" % (
+                PAGE_CSS,
+                ZOOM_CSS[self.zoom_style],
+                site_css,
             )
-            fn.write("        } catch(e) {\n")
-            fn.write("          console.error('decodeAudioData exception:', e);\n")
-            fn.write("          fallbackToHTMLAudio();\n")
-            fn.write("        }\n")
-            fn.write("      },\n")
-            fn.write("      function(error) {\n")
-            fn.write("        console.error('Load error:', error);\n")
-            fn.write("        fallbackToHTMLAudio();\n")
-            fn.write("      }\n")
-            fn.write("    );\n")
-            fn.write("  }\n")
-            fn.write("  \n")
-            fn.write("  function fallbackToHTMLAudio() {\n")
-            fn.write("    try {\n")
-            fn.write("      fallbackAudio = new Audio(audioUrl);\n")
-            fn.write("      fallbackAudio.loop = true;\n")
-            fn.write("      var playPromise = fallbackAudio.play();\n")
-            fn.write("      if (playPromise && playPromise.catch) {\n")
-            fn.write("        playPromise.catch(function(error) {\n")
-            fn.write("          console.error('HTML5 audio play failed:', error);\n")
-            fn.write("        });\n")
-            fn.write("      }\n")
-            fn.write("      isPlaying = true;\n")
-            fn.write("    } catch(e) {\n")
-            fn.write("      console.error('Fallback audio failed:', e);\n")
-            fn.write("    }\n")
-            fn.write("  }\n")
-            fn.write("  \n")
-            fn.write("  function startAudio() {\n")
-            fn.write("    var overlay = document.getElementById('unmute-overlay');\n")
-            fn.write("    if (overlay) {\n")
-            fn.write("      overlay.style.display = 'none';\n")
-            fn.write("    }\n")
-            fn.write("    \n")
-            fn.write("    if (hasWebAudio()) {\n")
-            fn.write("      try {\n")
-            fn.write("        playWebAudio();\n")
-            fn.write("      } catch(e) {\n")
-            fn.write("        console.error('Web Audio failed:', e);\n")
-            fn.write("        fallbackToHTMLAudio();\n")
-            fn.write("      }\n")
-            fn.write("    } else {\n")
-            fn.write("      fallbackToHTMLAudio();\n")
-            fn.write("    }\n")
-            fn.write("  }\n")
-            fn.write("  \n")
-            fn.write("  var overlay = document.getElementById('unmute-overlay');\n")
-            fn.write("  if (overlay) {\n")
-            fn.write("    overlay.addEventListener('click', function(e) {\n")
-            fn.write("      e.preventDefault();\n")
-            fn.write("      startAudio();\n")
-            fn.write("    });\n")
-            fn.write("    overlay.addEventListener('touchend', function(e) {\n")
-            fn.write("      e.preventDefault();\n")
-            fn.write("      startAudio();\n")
-            fn.write("    });\n")
-            fn.write("  }\n")
-            fn.write("  \n")
-            fn.write("  document.addEventListener('keydown', function(e) {\n")
-            fn.write("    var modifierKeys = [16, 17, 18];\n")
-            fn.write("    if (modifierKeys.indexOf(e.keyCode) !== -1) {\n")
-            fn.write("      return;\n")
-            fn.write("    }\n")
-            fn.write("    if (overlay && overlay.style.display !== 'none') {\n")
-            fn.write("      startAudio();\n")
-            fn.write("    }\n")
-            fn.write("  });\n")
-            fn.write("})();\n")
-            fn.write("</script>\n")
-
-            fn.write("<script type='application/json' id='ytmnd-data'>\n")
-            fn.write(json.dumps(ytmnd_info, sort_keys=True, indent=2) + "\n")
-            fn.write("</script>\n")
-
-            fn.write("</html>")
-
-    def write_zoom_text(self, fn, ytmnd_info):
+            script = "<script>\n%s</script>\n" % PAGE_JS
+
+        audio_tag = ""
+        if self.no_web_audio:
+            audio_tag = "<audio src='%s' loop autoplay></audio>\n" % wav
+
+        # keep "</script>" inside the json from closing the data block early
+        data = json.dumps(ytmnd_info, sort_keys=True, indent=2).replace("</", "<\\/")
+
+        return PAGE_TEMPLATE.substitute(
+            title=html.escape(title),
+            styles=styles,
+            audio=wav,
+            zoom_text=self.render_zoom_text(ytmnd_info),
+            audio_tag=audio_tag,
+            script=script,
+            data=data,
+        )
+
+    def write_assets(self, directory="."):
+        directory = os.path.abspath(directory)
+        with self.lock:
+            if directory in self.assets_written:
+                return
+            css = PAGE_CSS + ZOOM_CSS["classes"] + ZOOM_CSS["shadow"]
+            for name, content in (("ytmnd.css", css), ("ytmnd.js", PAGE_JS)):
+                path = os.path.join(directory, name)
+                with open(path + ".part", "w", encoding="utf-8") as fn:
+                    fn.write(content)
+                os.replace(path + ".part", path)
+            self.assets_written.add(directory)
+
+    def render_zoom_text(self, ytmnd_info):
         if "zoom_text" not in ytmnd_info["site"]:
-            return
+            return ""
 
         zoom_text = ytmnd_info["site"]["zoom_text"]
 
-        fn.write('<div id="zoom_text">')
-
+        layers = []
         offset = 100
-        if "line_3" in zoom_text and len(zoom_text["line_3"]) > 0:
-            self.write_zoom_layers(fn, zoom_text["line_3"], offset, 269)
-            offset += 21
-        if "line_2" in zoom_text and len(zoom_text["line_2"]) > 0:
-            self.write_zoom_layers(fn, zoom_text["line_2"], offset, 135)
+        for key, top in ZOOM_LINES:
+            if key not in zoom_text or len(zoom_text[key]) == 0:
+                continue
+
+            text = html.escape(zoom_text[key])
+            if self.zoom_style == "classes":
+                layers.append(
+                    "<div class='zl%s'>%s</div>"
+                    % (
+                        key[-1],
+                        "".join(
+                            "<div class='z%d'>%s</div>" % (i, text)
+                            for i in range(1, 22)
+                        ),
+                    )
+                )
+            elif self.zoom_style == "shadow":
+                layers.append("<div class='zs zs%s'>%s</div>" % (key[-1], text))
+            else:
+                layers.append(self.render_zoom_layers(text, offset, top))
             offset += 21
-        if "line_1" in zoom_text and len(zoom_text["line_1"]) > 0:
-            self.write_zoom_layers(fn, zoom_text["line_1"], offset, 1)
 
-        fn.write("</div>")
+        return '<div id="zoom_text">%s</div>' % "".join(layers)
 
-    def write_zoom_layers(self, fn, text, offset, top):
+    def render_zoom_layers(self, text, offset, top):
+        layers = []
         for i in range(1, 22):
-            z_index = offset + i
-            row_left = i * 2
-            row_top = top + i
-            font_size = i * 2
-            if i == 21:
-                color = 0
-            else:
-                color = i * 4
-
-            fn.write(
+            row_left, row_top, color, font_size = zoom_layer(i)
+            layers.append(
                 "<div style='z-index: %d; left: %dpx; top: %dpx; color: rgb(%d, %d, %d); font-size: %dpt;'>%s</div>"
-                % (z_index, row_left, row_top, color, color, color, font_size, text)
+                % (
+                    offset + i,
+                    row_left,
+                    top + row_top,
+                    color,
+                    color,
+                    color,
+                    font_size,
+                    text,
+                )
             )
+        return "".join(layers)
 
     def parse_json(self, ytmnd_info):
         domain = ytmnd_info["site"]["domain"]
@@ -449,8 +2084,7 @@ class YTMND:
         title = ytmnd_info["site"]["description"]
         placement = ytmnd_info["site"]["foreground"]["placement"]
 
-        gif_type = ytmnd_info["site"]["foreground"]["url"].split(".")[-1]
-        wav_type = ytmnd_info["site"]["sound"]["type"]
+        gif_type, wav_type = self.media_types(ytmnd_info)
         zoom_text = ytmnd_info["site"]["zoom_text"]
         keywords = ytmnd_info["site"]["keywords"]
         username = ytmnd_info["site"]["user"]["user_name"]
@@ -461,12 +2095,6 @@ class YTMND:
         if len(zoom_text["line_1"]) == 0:
             zoom_text = ""
 
-        if "alternates" in ytmnd_info["site"]["sound"]:
-            key = list(ytmnd_info["site"]["sound"]["alternates"].keys())[0]
-            value = ytmnd_info["site"]["sound"]["alternates"][key]
-            if value["file_type"] != "swf":
-                wav_type = ytmnd_info["site"]["sound"]["file_type"]
-
         simplified_info = {
             "domain": domain,
             "title": title,
@@ -475,6 +2103,7 @@ class YTMND:
             "bgcolor": bgcolor,
             "placement": placement,
             "zoom_text": zoom_text,
+            "keywords": keywords,
             "image": domain + "." + gif_type,
             "sound": domain + "." + wav_type,
             "image_type": gif_type,
@@ -489,26 +2118,596 @@ class YTMND:
         with open(domain + ".json", "w", encoding="utf-8") as fn:
             fn.write(json.dumps(data))
 
+    def archive_pages(self, paths):
+        pages = []
+        for path in paths:
+            for directory, _, names in os.walk(path):
+                pages.extend(
+                    os.path.join(directory, name)
+                    for name in sorted(names)
+                    if name.endswith(".html")
+                )
+        return pages
+
+    def map_pages(self, pages, settings):
+        with lazy_import("concurrent.futures").ProcessPoolExecutor(
+            max_workers=self.processes,
+            initializer=init_renderer,
+            initargs=(settings,),
+        ) as pool:
+            return list(pool.map(render_page, pages, chunksize=64))
+
+    def render_archive(self, paths):
+        pages = self.archive_pages(paths)
+        settings = {name: getattr(self, name) for name in RENDER_SETTINGS}
+        results = self.map_pages(pages, settings)
+
+        parsed = {}
+        for page, result in zip(pages, results):
+            if result is not None:
+                parsed.setdefault(os.path.dirname(page), []).append(result)
+
+        for directory, records in parsed.items():
+            if self.shared_assets and not self.json_only:
+                self.write_assets(directory)
+            if not self.html_only:
+                self.write_json(os.path.abspath(directory), records)
+            if self.index is not None:
+                self.index.add(records)
+
+        print(">> rendered %d pages" % sum(len(r) for r in parsed.values()))
+
+    def write_catalog(self, root="."):
+        # only the embedded json is read, the pages themselves are left alone
+        pages = self.archive_pages([root])
+        results = self.map_pages(pages, {"json_only": True})
+
+        entries = []
+        for page, record in zip(pages, results):
+            if record is None:
+                continue
+            directory = os.path.relpath(os.path.dirname(page), root)
+            entries.append(
+                {
+                    "domain": record["domain"],
+                    "title": record["title"],
+                    "username": record["username"],
+                    "work_safe": record["work_safe"],
+                    "page": posix_path(directory, os.path.basename(page)),
+                    "image": posix_path(directory, record["image"]),
+                }
+            )
+        entries.sort(key=lambda entry: (entry["username"] or "", entry["domain"]))
+
+        per_page = max(1, self.per_page)
+        shards = [entries[i : i + per_page] for i in range(0, len(entries), per_page)]
+        shards = shards or [[]]
+        catalog = os.path.join(root, "catalog")
+        os.makedirs(catalog, exist_ok=True)
+
+        for number, shard in enumerate(shards, 1):
+            with open(
+                os.path.join(catalog, "%04d.json" % number), "w", encoding="utf-8"
+            ) as fn:
+                json.dump(shard, fn)
+
+            # the pages live in catalog/ too, where they can't overwrite a site
+            # whose domain happens to be "index"
+            with open(
+                os.path.join(catalog, catalog_page(number)), "w", encoding="utf-8"
+            ) as fn:
+                fn.write(self.render_catalog(shard, number, len(shards), len(entries)))
+
+        with open(os.path.join(catalog, "index.json"), "w", encoding="utf-8") as fn:
+            json.dump(
+                {
+                    "sites": len(entries),
+                    "per_page": per_page,
+                    "shards": ["%04d.json" % n for n in range(1, len(shards) + 1)],
+                },
+                fn,
+            )
+
+        print(">> catalogued %d sites on %d pages" % (len(entries), len(shards)))
+
+    def render_catalog(self, entries, number, pages, total):
+        items = []
+        for entry in entries:
+            items.append(
+                "<li><a href='%s'><img src='%s' loading='lazy' decoding='async' "
+                "width='120' height='90' alt=''><b>%s</b></a><span>%s%s</span></li>"
+                % (
+                    html.escape("../" + entry["page"]),
+                    html.escape("../" + entry["image"]),
+                    html.escape(entry["domain"]),
+                    html.escape(entry["title"] or ""),
+                    "" if entry["work_safe"] else " <em>nsfw</em>",
+                )
+            )
+
+        nav = []
+        if number > 1:
+            nav.append("<a href='%s'>&larr; prev</a>" % catalog_page(number - 1))
+        nav.append("page %d of %d" % (number, pages))
+        if number < pages:
+            nav.append("<a href='%s'>next &rarr;</a>" % catalog_page(number + 1))
+
+        return CATALOG_TEMPLATE.substitute(
+            number=number,
+            total=total,
+            nav=" ".join(nav),
+            items="\n".join(items),
+        )
+
+
+def domain_name(name):
+    return (
+        name.replace("http://", "")
+        .replace(".ytmnsfw.com", "")
+        .replace(".ytmnd.com", "")
+        .replace("/", "")
+    )
+
+
+def parse_targets(lines, user_mode=False):
+    # one target per line; "user:" or "domain:" prefixes override -u
+    domains = []
+    users = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        kind, _, name = line.partition(":")
+        if kind == "user":
+            users.append(name.strip())
+        elif kind == "domain":
+            domains.append(domain_name(name.strip()))
+        elif user_mode:
+            users.append(line)
+        else:
+            domains.append(domain_name(line))
+
+    return list(dict.fromkeys(domains)), list(dict.fromkeys(users))
+
+
+def asset_urls(ytmnd_info):
+    # every http url in the parts of the info json that describe media,
+    # mapped to the json paths that reference it
+    urls = {}
+
+    def walk(value, path):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                walk(item, path + [str(key)])
+        elif isinstance(value, list):
+            for i, item in enumerate(value):
+                walk(item, path + [str(i)])
+        elif isinstance(value, str):
+            value = value.strip()
+            if value.startswith(("http://", "https://")):
+                urls.setdefault(value, []).append(".".join(path))
+
+    for key in ASSET_SECTIONS:
+        if key in ytmnd_info["site"]:
+            walk(ytmnd_info["site"][key], [key])
+    return urls
+
+
+def asset_name(url):
+    # short url hash first so that assets with the same file name don't collide
+    name = os.path.basename(urlsplit(url).path) or "index"
+    name = re.sub(r"[^\w.-]", "_", name)[-80:]
+    return "%s-%s" % (hashlib.sha1(url.encode("utf-8")).hexdigest()[:8], name)
+
+
+def link_file(blob, path):
+    if os.path.exists(path):
+        if os.path.samefile(blob, path):
+            return
+        os.remove(path)
+    try:
+        os.link(blob, path)
+    except OSError:
+        shutil.copyfile(blob, path)
+
+
+def transcode_audio(source, target, audio):
+    subprocess.run(
+        ["ffmpeg", "-nostdin", "-v", "error", "-y", "-i", source, "-vn"]
+        + TRANSCODE_ARGS[audio]
+        + [target],
+        check=True,
+        capture_output=True,
+    )
+
+
+def optimize_gif(source, target):
+    subprocess.run(
+        ["gifsicle", "-O3", source, "-o", target], check=True, capture_output=True
+    )
+
+
+def archive_handler():
+    # built on first use so that only `serve` pays for importing http.server
+    server = lazy_import("http.server")
+    email_utils = lazy_import("email.utils")
+
+    class ArchiveHandler(server.SimpleHTTPRequestHandler):
+        # static file handler for archives: keep-alive, byte ranges for audio
+        # seeking, etags and conditional gets, precompressed .br/.gz variants,
+        # and sendfile() so file bodies never pass through python
+        protocol_version = "HTTP/1.1"
+        extensions_map = dict(
+            server.SimpleHTTPRequestHandler.extensions_map,
+            **{
+                ".mp3": "audio/mpeg",
+                ".wav": "audio/wav",
+                ".ogg": "audio/ogg",
+                ".json": "application/json",
+                ".ndjson": "application/x-ndjson",
+            },
+        )
+        encodings = (("br", ".br"), ("gzip", ".gz"))
+        revalidate = (".html", ".json", ".ndjson")
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            self.serve_file(True)
+
+        def do_HEAD(self):
+            self.serve_file(False)
+
+        def serve_file(self, body):
+            path = self.translate_path(self.path)
+            if os.path.isdir(path):
+                index = os.path.join(path, "index.html")
+                redirect = not urlsplit(self.path).path.endswith("/")
+                if redirect or not os.path.isfile(index):
+                    if body:
+                        return server.SimpleHTTPRequestHandler.do_GET(self)
+                    return server.SimpleHTTPRequestHandler.do_HEAD(self)
+                path = index
+            if not os.path.isfile(path):
+                return self.send_error(404, "File not found")
+
+            content_type = self.guess_type(path)
+            encoding = None
+            if "Range" not in self.headers:
+                accepted = accepted_encodings(self.headers.get("Accept-Encoding", ""))
+                for name, suffix in self.encodings:
+                    variant = path + suffix
+                    if (
+                        accepted.get(name, accepted.get("*", 0)) > 0
+                        and os.path.isfile(variant)
+                        and os.path.getmtime(variant) >= os.path.getmtime(path)
+                    ):
+                        path, encoding = variant, name
+                        break
+
+            with open(path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                size = stat.st_size
+                etag = '"%x-%x%s"' % (
+                    int(stat.st_mtime),
+                    size,
+                    "-" + encoding if encoding else "",
+                )
+                headers = {
+                    "ETag": etag,
+                    "Last-Modified": email_utils.formatdate(stat.st_mtime, usegmt=True),
+                    "Cache-Control": (
+                        "no-cache"
+                        if path.endswith(self.revalidate)
+                        or path[:-3].endswith(self.revalidate)
+                        else "public, max-age=86400"
+                    ),
+                    "Accept-Ranges": "bytes",
+                    "Vary": "Accept-Encoding",
+                }
+
+                if self.not_modified(etag, stat.st_mtime):
+                    self.send_response(304)
+                    for name, value in headers.items():
+                        self.send_header(name, value)
+                    self.end_headers()
+                    return
+
+                start, end = 0, size - 1
+                status = 200
+                if "Range" in self.headers and size:
+                    byte_range = self.byte_range(self.headers["Range"], size)
+                    if byte_range is None:
+                        self.send_response(416)
+                        self.send_header("Content-Range", "bytes */%d" % size)
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    start, end = byte_range
+                    status = 206
+                    headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, size)
+
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(end - start + 1))
+                if encoding:
+                    self.send_header("Content-Encoding", encoding)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+
+                if body and end >= start:
+                    self.connection.sendfile(f, start, end - start + 1)
+
+        def not_modified(self, etag, mtime):
+            if "If-None-Match" in self.headers:
+                tags = [tag.strip() for tag in self.headers["If-None-Match"].split(",")]
+                return etag in tags or "*" in tags
+            if "If-Modified-Since" in self.headers:
+                try:
+                    since = email_utils.parsedate_to_datetime(
+                        self.headers["If-Modified-Since"]
+                    )
+                except (TypeError, ValueError):
+                    return False
+                return int(mtime) <= since.timestamp()
+            return False
+
+        def byte_range(self, value, size):
+            # single ranges only, which is all audio elements and xhr ask for
+            unit, _, spec = value.partition("=")
+            if unit.strip() != "bytes" or "," in spec:
+                return None
+            first, _, last = spec.strip().partition("-")
+            try:
+                if first:
+                    start = int(first)
+                    end = int(last) if last else size - 1
+                else:
+                    start = size - int(last)
+                    end = size - 1
+            except ValueError:
+                return None
+            start = max(0, start)
+            end = min(end, size - 1)
+            if start > end:
+                return None
+            return start, end
+
+    return ArchiveHandler
+
+
+def accepted_encodings(header):
+    # Accept-Encoding as {coding: q}, so "gzip;q=0" counts as a refusal
+    accepted = {}
+    for item in header.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding.lower()] = q
+    return accepted
+
+
+def precompress(root):
+    # write .gz (and .br when the brotli module is installed) next to every
+    # text file that is missing one or has changed since
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+
+    written = 0
+    for directory, _, names in os.walk(root):
+        for name in names:
+            if not name.endswith((".html", ".json", ".ndjson", ".css", ".js")):
+                continue
+            path = os.path.join(directory, name)
+            variants = [(".gz", lambda data: gzip.compress(data, 9))]
+            if brotli is not None:
+                variants.append((".br", brotli.compress))
+            for suffix, compress in variants:
+                variant = path + suffix
+                if os.path.exists(variant) and os.path.getmtime(
+                    variant
+                ) >= os.path.getmtime(path):
+                    continue
+                with open(path, "rb") as f:
+                    data = compress(f.read())
+                with open(variant + ".part", "wb") as f:
+                    f.write(data)
+                os.replace(variant + ".part", variant)
+                written += 1
+    return written
+
+
+def serve_archive(root=".", bind="127.0.0.1", port=8000):
+    handler = partial(archive_handler(), directory=root)
+    server = lazy_import("http.server").ThreadingHTTPServer((bind, port), handler)
+    server.daemon_threads = True
+    print(">> serving %s on http://%s:%d/" % (root, bind, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def posix_path(directory, name):
+    return os.path.normpath(os.path.join(directory, name)).replace(os.sep, "/")
+
+
+def catalog_page(number):
+    return "index.html" if number == 1 else "index-%d.html" % number
+
+
+def read_info(path):
+    with open(path, encoding="utf-8") as fn:
+        match = DATA_BLOCK.search(fn.read())
+    if not match:
+        return None
+    return json.loads(match.group(1))
+
+
+renderer = None
+
+
+def init_renderer(settings):
+    global renderer
+    renderer = YTMND()
+    for name, value in settings.items():
+        setattr(renderer, name, value)
+
+
+def render_page(path):
+    try:
+        ytmnd_info = read_info(path)
+        if ytmnd_info is None:
+            return None
+
+        if not renderer.json_only:
+            with open(path + ".part", "w", encoding="utf-8") as fn:
+                fn.write(renderer.render_index(ytmnd_info))
+            os.replace(path + ".part", path)
+
+        return renderer.parse_json(ytmnd_info)
+    except (KeyError, OSError, ValueError) as e:
+        print(f"Error rendering {path}: {e}")
+        return None
+
 
 if __name__ == "__main__":
     parser = OptionParser()
 
     parser.add_option("-u", "--user", action="store_true")
+    parser.add_option("-i", "--input", action="store", dest="input")
     parser.add_option("-m", "--media-only", action="store_true")
     parser.add_option("-f", "--html-only", action="store_true")
     parser.add_option("-j", "--json-only", action="store_true")
     parser.add_option("-w", "--no-web-audio", action="store_true")
     parser.add_option("-p", "--print-json", action="store_true")
+    parser.add_option("-n", "--ndjson", action="store_true")
+    parser.add_option(
+        "--compress",
+        action="store",
+        type="choice",
+        choices=("gzip", "zstd"),
+        dest="compress",
+    )
+    parser.add_option("-a", "--shared-assets", action="store_true")
+    parser.add_option(
+        "-z",
+        "--zoom-style",
+        action="store",
+        type="choice",
+        choices=ZOOM_STYLES,
+        dest="zoom_style",
+        default="layers",
+    )
+    parser.add_option(
+        "-s", "--sleep", action="store", type="float", dest="sleep", default=1
+    )
+    parser.add_option("-r", "--rate", action="store", type="float", dest="rate")
+    parser.add_option(
+        "-b", "--burst", action="store", type="int", dest="burst", default=4
+    )
+    parser.add_option(
+        "-t", "--workers", action="store", type="int", dest="workers", default=1
+    )
+    parser.add_option(
+        "--page-workers", action="store", type="int", dest="page_workers", default=4
+    )
+    parser.add_option(
+        "--media-workers", action="store", type="int", dest="media_workers"
+    )
+    parser.add_option(
+        "--render-workers",
+        action="store",
+        type="int",
+        dest="render_workers",
+        default=2,
+    )
+    parser.add_option("--queue-size", action="store", type="int", dest="queue_size")
+    parser.add_option(
+        "--pool-size", action="store", type="int", dest="pool_size", default=10
+    )
+    parser.add_option(
+        "--timeout", action="store", type="float", dest="timeout", default=30
+    )
+    parser.add_option(
+        "--retries", action="store", type="int", dest="retries", default=3
+    )
+    parser.add_option(
+        "--backoff", action="store", type="float", dest="backoff", default=1.0
+    )
+    parser.add_option(
+        "--max-retry-after",
+        action="store",
+        type="float",
+        dest="max_retry_after",
+        default=300,
+    )
+    parser.add_option("--proxy", action="store", dest="proxy")
+    parser.add_option("--bind", action="store", dest="bind", default="127.0.0.1")
+    parser.add_option("--port", action="store", type="int", dest="port", default=8000)
+    parser.add_option("--precompress", action="store_true")
+    parser.add_option("--index", action="store", dest="index")
+    parser.add_option("--by", action="store", dest="by")
+    parser.add_option("--sfw", action="store_true")
+    parser.add_option("--nsfw", action="store_true")
+    parser.add_option("--limit", action="store", type="int", dest="limit")
+    parser.add_option("--fresh", action="store_true")
+    parser.add_option("--stats", action="store_true")
+    parser.add_option("--profile-startup", action="store_true")
+    parser.add_option("--metrics", action="store", dest="metrics")
+    parser.add_option("--processes", action="store", type="int", dest="processes")
+    parser.add_option(
+        "--per-page", action="store", type="int", dest="per_page", default=200
+    )
+    parser.add_option("--store", action="store", dest="store")
+    parser.add_option(
+        "--transcode", action="store", dest="transcode", choices=sorted(TRANSCODE_ARGS)
+    )
+    parser.add_option("--optimize-gifs", action="store_true", dest="optimize_gifs")
+    parser.add_option("--deep", action="store_true")
+    parser.add_option(
+        "--asset-workers", action="store", type="int", dest="asset_workers", default=8
+    )
+    parser.add_option(
+        "--transcode-cache",
+        action="store",
+        dest="transcode_cache",
+        default="transcoded",
+    )
+    parser.add_option("-c", "--cache", action="store", dest="cache")
+    parser.add_option(
+        "--cache-ttl", action="store", type="float", dest="cache_ttl", default=86400
+    )
     parser.add_option(
-        "-s", "--sleep", action="store", type="int", dest="sleep", default=5
+        "--cache-size", action="store", type="int", dest="cache_size", default=256
     )
 
     (options, args) = parser.parse_args()
 
-    if len(args) == 0:
+    if len(args) == 0 and not options.input:
         parser.error("incorrect number of arguments")
         sys.exit(1)
 
+    if options.compress == "zstd":
+        try:
+            lazy_import("zstandard")
+        except ImportError:
+            parser.error("--compress zstd needs the zstandard package")
+
     ytmnd = YTMND()
     ytmnd.user_mode = options.user
     ytmnd.media_only = options.media_only
@@ -516,18 +2715,125 @@ if __name__ == "__main__":
     ytmnd.json_only = options.json_only
     ytmnd.no_web_audio = options.no_web_audio
     ytmnd.print_json = options.print_json
+    ytmnd.shared_assets = options.shared_assets
+    ytmnd.zoom_style = options.zoom_style
+    ytmnd.ndjson = options.ndjson
+    ytmnd.compress = options.compress
     ytmnd.sleep = options.sleep
+    ytmnd.rate = options.rate
+    ytmnd.burst = options.burst
+    ytmnd.workers = options.workers
+    ytmnd.page_workers = options.page_workers
+    ytmnd.media_workers = options.media_workers
+    ytmnd.render_workers = options.render_workers
+    ytmnd.queue_size = options.queue_size
+    ytmnd.pool_size = options.pool_size
+    ytmnd.timeout = options.timeout
+    ytmnd.retries = options.retries
+    ytmnd.backoff = options.backoff
+    ytmnd.max_retry_after = options.max_retry_after
+    ytmnd.proxy = options.proxy
+    ytmnd.fresh = options.fresh
+    ytmnd.processes = options.processes
+    ytmnd.per_page = options.per_page
+    ytmnd.deep = options.deep
+    ytmnd.asset_workers = options.asset_workers
+    if options.store:
+        ytmnd.store = MediaStore(os.path.abspath(options.store))
+    if options.transcode or options.optimize_gifs:
+        if options.transcode and not shutil.which("ffmpeg"):
+            parser.error("--transcode needs ffmpeg on the PATH")
+        if options.optimize_gifs and not shutil.which("gifsicle"):
+            parser.error("--optimize-gifs needs gifsicle on the PATH")
+        ytmnd.transcoder = Transcoder(
+            os.path.abspath(options.transcode_cache),
+            options.transcode,
+            options.optimize_gifs,
+            options.processes,
+        )
+    if options.cache:
+        ytmnd.cache = ResponseCache(
+            options.cache, options.cache_ttl, options.cache_size * 1024 * 1024
+        )
+
+    if options.index:
+        ytmnd.index = ArchiveIndex(options.index)
+
+    # with -u or -i every argument is a target, so a user or a domain that
+    # happens to share a subcommand's name is still fetched
+    command = None
+    if args and not (options.user or options.input):
+        if args[0] in ("query", "render", "serve", "catalog", "batch"):
+            command = args[0]
+
+    if command == "query":
+        if not ytmnd.index:
+            parser.error("query needs --index")
+        work_safe = True if options.sfw else False if options.nsfw else None
+        for record in ytmnd.index.query(
+            " ".join(args[1:]), options.by, work_safe, options.limit
+        ):
+            if options.json_only:
+                print(json.dumps(record))
+            else:
+                print(
+                    "%s\t%s\t%s"
+                    % (record["domain"], record["username"], record["title"])
+                )
 
-    if options.user:
-        user = args[0]
-        ytmnd.fetch_user(user)
+    elif command == "render":
+        ytmnd.render_archive(args[1:] or ["."])
+
+    elif command == "serve":
+        root = args[1] if len(args) > 1 else "."
+        if options.precompress:
+            print(">> compressed %d files" % precompress(root))
+        serve_archive(root, options.bind, options.port)
+
+    elif command == "catalog":
+        for root in args[1:] or ["."]:
+            ytmnd.write_catalog(root)
 
     else:
-        name = (
-            args[0]
-            .replace("http://", "")
-            .replace(".ytmnsfw.com", "")
-            .replace(".ytmnd.com", "")
-            .replace("/", "")
+        try:
+            if command == "batch":
+                if options.json_only:
+                    parser.error("batch does not collect --json-only records")
+                ytmnd.run_batch(sys.stdin)
+            else:
+                lines = list(args)
+                if options.input == "-":
+                    lines.extend(sys.stdin)
+                elif options.input:
+                    with open(options.input, encoding="utf-8") as fn:
+                        lines.extend(fn)
+
+                domains, users = parse_targets(lines, options.user)
+                if len(domains) == 1 and not users and not options.json_only:
+                    ytmnd.fetch_ytmnd(domains[0])
+                else:
+                    # json records from a domain list are named after the
+                    # list file, or "domains"
+                    name = "domains"
+                    if options.input and options.input != "-":
+                        name = os.path.splitext(os.path.basename(options.input))[0]
+                    ytmnd.fetch_all(domains, users, name)
+        finally:
+            if ytmnd.transcoder is not None:
+                ytmnd.transcoder.close()
+
+        if options.stats:
+            print(ytmnd.metrics.summary())
+        if options.metrics:
+            ytmnd.metrics.write(options.metrics)
+
+    if options.profile_startup:
+        print(
+            ">> %.1f ms from import to exit, %.1f ms of it in top-level imports\n%s"
+            % (
+                (time.perf_counter() - IMPORTS_STARTED) * 1000,
+                (STARTED - IMPORTS_STARTED) * 1000,
+                import_report(),
+            ),
+            file=sys.stderr,
         )
-        ytmnd.fetch_ytmnd(name)